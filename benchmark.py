@@ -0,0 +1,471 @@
+"""Load and latency benchmark for the CodeAtEase API.
+
+The app is served by uvicorn on a local port inside this process, talking to
+fake GitHub and chat-completions backends, so no network access or credentials
+are needed and runs are repeatable.
+
+    python benchmark.py
+    python benchmark.py --scenarios chat,chat_stream --router-latency 1.5 --router-503-rate 0.2
+    python benchmark.py --baseline latest
+
+Every run is written to benchmarks/results/<timestamp>.json; --baseline
+compares the new run against an earlier file (or the most recent one).
+"""
+import argparse
+import asyncio
+import base64
+import glob
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+# The app reads its configuration at import time
+BENCH_DIR = tempfile.mkdtemp(prefix="codeatease-bench-")
+os.environ.setdefault("SESSION_DB_PATH", os.path.join(BENCH_DIR, "sessions.db"))
+os.environ.setdefault("BLOB_CACHE_DIR", os.path.join(BENCH_DIR, "blobs"))
+os.environ.setdefault("HF_TOKEN", "bench-token")
+os.environ.setdefault("HF_ROUTER_URL", "https://router.bench/v1/chat/completions")
+os.environ.setdefault("GITHUB_CLIENT_ID", "bench-client")
+os.environ.setdefault("GITHUB_CLIENT_SECRET", "bench-secret")
+os.environ.setdefault("TOKENIZER_NAME", os.path.join(BENCH_DIR, "no-tokenizer.json"))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import httpx
+import uvicorn
+import main
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "results")
+SCENARIOS = ("login", "repos", "tree", "file", "push", "chat", "chat_stream")
+
+# ==================== FAKE BACKENDS ====================
+
+def blob_sha(data: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+async def delay(latency: float, jitter: float):
+    if latency or jitter:
+        await asyncio.sleep(latency + random.uniform(0, jitter))
+
+class FakeGitHub:
+    """Enough of api.github.com and the OAuth endpoint for every scenario.
+
+    Repository listings are paginated with Link headers, and read endpoints
+    return ETags and honour If-None-Match, like GitHub does.
+    """
+
+    def __init__(self, latency: float, jitter: float, repos: int, per_page: int, tree_size: int, files_per_dir: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.repos = [{
+            "id": i, "name": f"repo{i}", "full_name": f"bench/repo{i}", "owner": {"login": "bench"},
+            "description": None, "private": False, "html_url": f"https://github.com/bench/repo{i}",
+            "clone_url": f"https://github.com/bench/repo{i}.git", "language": "Python", "stargazers_count": i,
+            "forks_count": 0, "size": 100, "updated_at": "2024-01-01T00:00:00Z",
+            "created_at": "2023-01-01T00:00:00Z", "default_branch": "main"
+        } for i in range(repos)]
+        self.per_page = per_page
+        self.files: Dict[str, bytes] = {}
+        for i in range(tree_size):
+            path = f"src/pkg{i // files_per_dir}/module{i}.py"
+            self.files[path] = (f"def function_{i}(value):\n    return value * {i}\n" * 20).encode("utf-8")
+        self.files["README.md"] = b"# Benchmark repository\n"
+        self.blobs = {blob_sha(data): data for data in self.files.values()}
+        self.trees: Dict[str, List[Dict[str, Any]]] = {}
+        self.commits: Dict[str, str] = {}
+        self.head = self.commit(self.root_tree())
+
+    def root_tree(self) -> str:
+        entries, folders = [], set()
+        for path, data in self.files.items():
+            parts = path.split("/")
+            for depth in range(1, len(parts)):
+                folders.add("/".join(parts[:depth]))
+            entries.append({"path": path, "mode": "100644", "type": "blob", "sha": blob_sha(data), "size": len(data)})
+        for folder in folders:
+            entries.append({"path": folder, "mode": "040000", "type": "tree", "sha": self.folder_sha(folder)})
+        return self.store_tree(entries)
+
+    def folder_sha(self, folder: str) -> str:
+        return hashlib.sha1(f"tree:{folder}".encode("utf-8")).hexdigest()
+
+    def store_tree(self, entries: List[Dict[str, Any]]) -> str:
+        sha = hashlib.sha1(json.dumps(sorted(e["path"] + e["sha"] for e in entries)).encode("utf-8")).hexdigest()
+        self.trees[sha] = entries
+        return sha
+
+    def commit(self, tree_sha: str) -> str:
+        sha = hashlib.sha1(f"commit:{tree_sha}:{len(self.commits)}".encode("utf-8")).hexdigest()
+        self.commits[sha] = tree_sha
+        return sha
+
+    def tree_listing(self, sha: str, recursive: bool) -> Optional[List[Dict[str, Any]]]:
+        if sha in self.trees:
+            entries = self.trees[sha]
+            return entries if recursive else [e for e in entries if "/" not in e["path"]]
+        # A folder SHA lists one level below that folder
+        for entry in self.trees[self.commits[self.head]]:
+            if entry["type"] == "tree" and entry["sha"] == sha:
+                prefix = entry["path"] + "/"
+                return [
+                    dict(e, path=e["path"][len(prefix):])
+                    for e in self.trees[self.commits[self.head]]
+                    if e["path"].startswith(prefix) and "/" not in e["path"][len(prefix):]
+                ]
+        return None
+
+    def cacheable(self, request: httpx.Request, payload: Any, headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+        body = json.dumps(payload).encode("utf-8")
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        headers = dict(headers or {}, etag=etag, **{"x-ratelimit-remaining": "4999"})
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304, headers=headers)
+        return httpx.Response(200, content=body, headers=dict(headers, **{"content-type": "application/json"}))
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        await delay(self.latency, self.jitter)
+        path, method = request.url.path, request.method
+        if request.url.host == "github.com" and path == "/login/oauth/access_token":
+            code = parse_qs(request.content.decode("utf-8")).get("code", ["0"])[0]
+            return httpx.Response(200, json={"access_token": f"gho_{code}"})
+        if path == "/user":
+            token = request.headers.get("authorization", "").split()[-1]
+            user_id = int(hashlib.sha1(token.encode("utf-8")).hexdigest()[:8], 16)
+            return httpx.Response(200, json={"id": user_id, "login": f"user{user_id}", "name": None, "email": None})
+        if path == "/user/repos":
+            page = int(request.url.params.get("page", 1))
+            per_page = min(int(request.url.params.get("per_page", 30)), self.per_page)
+            last = max(1, -(-len(self.repos) // per_page))
+            link = f'<{request.url.copy_merge_params({"page": last})}>; rel="last"' if page < last else ""
+            return self.cacheable(request, self.repos[(page - 1) * per_page:page * per_page], {"link": link} if link else None)
+
+        parts = path.strip("/").split("/")
+        if len(parts) < 3 or parts[0] != "repos":
+            return httpx.Response(404, json={"message": "Not Found"})
+        rest = parts[3:]
+        if not rest and method == "GET":
+            return self.cacheable(request, {"name": parts[2], "default_branch": "main"})
+        if rest[:2] == ["git", "trees"] and method == "GET":
+            tree_sha = self.commits[self.head] if rest[2] == "main" else rest[2]
+            listing = self.tree_listing(tree_sha, "recursive" in request.url.params)
+            if listing is None:
+                return httpx.Response(404, json={"message": "Not Found"})
+            return self.cacheable(request, {"sha": tree_sha, "truncated": False, "tree": listing})
+        if rest[:2] == ["git", "blobs"] and method == "GET":
+            data = self.blobs.get(rest[2])
+            if data is None:
+                return httpx.Response(404, json={"message": "Not Found"})
+            if "raw" in request.headers.get("accept", ""):
+                return httpx.Response(200, content=data)
+            return self.cacheable(request, {"sha": rest[2], "content": base64.b64encode(data).decode("ascii"), "encoding": "base64"})
+        if rest[:1] == ["contents"] and method == "GET":
+            file_path = "/".join(rest[1:])
+            data = self.files.get(file_path)
+            if data is None:
+                return httpx.Response(404, json={"message": "Not Found"})
+            return self.cacheable(request, {
+                "path": file_path, "name": rest[-1], "sha": blob_sha(data), "size": len(data),
+                "content": base64.b64encode(data).decode("ascii")
+            })
+        if rest[:3] == ["git", "ref", "heads"]:
+            return httpx.Response(200, json={"object": {"sha": self.head}})
+        if rest[:2] == ["git", "commits"] and method == "GET":
+            return httpx.Response(200, json={"sha": rest[2], "tree": {"sha": self.commits[rest[2]]}})
+        body = json.loads(request.content) if request.content else {}
+        if rest == ["git", "blobs"] and method == "POST":
+            data = base64.b64decode(body["content"])
+            self.blobs[blob_sha(data)] = data
+            return httpx.Response(201, json={"sha": blob_sha(data)})
+        if rest == ["git", "trees"] and method == "POST":
+            entries = {e["path"]: e for e in self.trees[body["base_tree"]]}
+            for entry in body["tree"]:
+                if entry.get("sha") is None:
+                    entries.pop(entry["path"], None)
+                else:
+                    entries[entry["path"]] = entry
+            return httpx.Response(201, json={"sha": self.store_tree(list(entries.values()))})
+        if rest == ["git", "commits"] and method == "POST":
+            return httpx.Response(201, json={"sha": self.commit(body["tree"])})
+        if rest[:3] == ["git", "refs", "heads"] and method == "PATCH":
+            self.head = body["sha"]
+            return httpx.Response(200, json={"object": {"sha": self.head}})
+        return httpx.Response(404, json={"message": "Not Found"})
+
+class FakeRouter:
+    """An OpenAI-compatible chat-completions endpoint with tunable latency and 503s"""
+
+    def __init__(self, latency: float, jitter: float, first_token: float, completion_tokens: int, error_rate: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.first_token = first_token
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        if random.random() < self.error_rate:
+            await delay(0.01, 0)
+            return httpx.Response(503, headers={"retry-after": "0"}, json={"error": "Model is loading"})
+        body = json.loads(request.content)
+        usage = {"prompt_tokens": sum(len(m["content"]) // 4 for m in body["messages"]), "completion_tokens": self.completion_tokens}
+        if not body.get("stream"):
+            await delay(self.latency, self.jitter)
+            text = " ".join(["token"] * self.completion_tokens)
+            return httpx.Response(200, json={"choices": [{"message": {"content": text}}], "usage": usage})
+
+        per_token = max(self.latency - self.first_token, 0) / max(self.completion_tokens, 1)
+
+        async def chunks():
+            await delay(self.first_token, self.jitter)
+            for _ in range(self.completion_tokens):
+                yield b'data: {"choices":[{"delta":{"content":"token "}}]}\n\n'
+                await asyncio.sleep(per_token)
+            yield ("data: %s\n\n" % json.dumps({"choices": [], "usage": usage})).encode("utf-8")
+            yield b"data: [DONE]\n\n"
+
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=chunks())
+
+# ==================== SCENARIOS ====================
+
+class Bench:
+    def __init__(self, client: httpx.AsyncClient, github: FakeGitHub):
+        self.client = client
+        self.github = github
+        self.tokens: List[str] = []
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.file_shas = {path: blob_sha(data) for path, data in github.files.items()}
+
+    async def timed(self, endpoint: str, method: str, url: str, expect: int = 200, **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        elapsed = time.perf_counter() - started
+        self.samples.setdefault(endpoint, []).append(elapsed)
+        if response.status_code != expect:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return response
+
+    def auth(self, i: int) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.tokens[i % len(self.tokens)]}"}
+
+    async def login(self, i: int):
+        response = await self.timed(
+            "GET /auth/github/callback", "GET", "/auth/github/callback",
+            expect=307, params={"code": f"bench{i}"}
+        )
+        token = parse_qs(urlparse(response.headers.get("location", "")).query).get("access_token")
+        if token:
+            self.tokens.append(token[0])
+
+    async def repos(self, i: int):
+        await self.timed("GET /api/repositories", "GET", "/api/repositories", headers=self.auth(i))
+
+    async def tree(self, i: int):
+        lazy = "true" if i % 2 else "false"
+        await self.timed(f"GET /api/repository/tree (lazy={lazy})", "GET", "/api/repository/tree/bench/repo0",
+                         params={"lazy": lazy}, headers=self.auth(i))
+
+    async def file(self, i: int):
+        path = random.choice(list(self.file_shas))
+        # Half the opens carry the SHA from the tree, as aipage.html does
+        params = {"path": path, "sha": self.file_shas[path]} if i % 2 else {"path": path}
+        await self.timed("GET /api/repository/file", "GET", "/api/repository/file/bench/repo0", params=params, headers=self.auth(i))
+
+    async def push(self, i: int):
+        paths = random.sample(list(self.file_shas), min(5, len(self.file_shas)))
+        changes = [{"path": path, "content": f"# edit {i}\n" + self.github.files[path].decode("utf-8")} for path in paths]
+        await self.timed("POST /api/repository/push", "POST", "/api/repository/push", headers=self.auth(i), json={
+            "owner": "bench", "repo": "repo0", "changes": changes, "commitMessage": f"bench {i}", "branch": "main"
+        })
+
+    def chat_body(self, i: int) -> Dict[str, Any]:
+        path = random.choice(list(self.file_shas))
+        return {
+            "prompt": f"Explain what function {i % 50} does",
+            "currentFile": {"path": path, "content": self.github.files[path].decode("utf-8"), "sha": self.file_shas[path]},
+            "owner": "bench",
+            "repo": "repo0"
+        }
+
+    async def chat(self, i: int):
+        await self.timed("POST /api/chat", "POST", "/api/chat", headers=self.auth(i), json=self.chat_body(i))
+
+    async def chat_stream(self, i: int):
+        started = time.perf_counter()
+        first = None
+        async with self.client.stream("POST", "/api/chat/stream", headers=self.auth(i), json=self.chat_body(i)) as response:
+            async for line in response.aiter_lines():
+                if first is None and line.startswith("data:"):
+                    first = time.perf_counter() - started
+        self.samples.setdefault("POST /api/chat/stream", []).append(time.perf_counter() - started)
+        self.samples.setdefault("POST /api/chat/stream (first event)", []).append(first or 0.0)
+        if response.status_code != 200:
+            self.errors["POST /api/chat/stream"] = self.errors.get("POST /api/chat/stream", 0) + 1
+
+async def run_load(operation: Callable, requests: int, concurrency: int) -> float:
+    """Issue ``requests`` operations with at most ``concurrency`` at a time; returns wall time"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            await operation(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return time.perf_counter() - started
+
+# ==================== REPORTING ====================
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    rank = max(1, int(round(fraction * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+def summarize(samples: List[float], errors: int, wall_time: float) -> Dict[str, Any]:
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "errors": errors,
+        "throughput_rps": round(len(ordered) / wall_time, 2) if wall_time else 0.0,
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2) if ordered else 0.0,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0
+    }
+
+def print_report(results: Dict[str, Dict[str, Any]], baseline: Optional[Dict[str, Dict[str, Any]]] = None):
+    header = f"{'endpoint':<46} {'n':>6} {'err':>5} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, stats in results.items():
+        print(f"{endpoint:<46} {stats['count']:>6} {stats['errors']:>5} {stats['throughput_rps']:>9} "
+              f"{stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+        previous = (baseline or {}).get(endpoint)
+        if previous:
+            changes = []
+            for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms"):
+                if previous[key]:
+                    changes.append(f"{key} {(stats[key] - previous[key]) / previous[key] * 100:+.1f}%")
+            print(f"{'':<46} vs baseline: {', '.join(changes)}")
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_baseline(path: str) -> Optional[Dict[str, Any]]:
+    if path == "latest":
+        runs = sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")))
+        if not runs:
+            return None
+        path = runs[-1]
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+# ==================== MAIN ====================
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    random.seed(args.seed)
+    github = FakeGitHub(args.github_latency, args.github_jitter, args.repos, args.per_page, args.tree_size, args.files_per_dir)
+    router = FakeRouter(args.router_latency, args.router_jitter, args.router_first_token, args.completion_tokens, args.router_503_rate)
+    main.github_client = httpx.AsyncClient(
+        transport=httpx.MockTransport(github),
+        event_hooks={"request": [main.github_request_started], "response": [main.github_response_received]}
+    )
+    main.ai_client = httpx.AsyncClient(transport=httpx.MockTransport(router))
+    main.start_logging()
+
+    # A real server rather than httpx.ASGITransport, which buffers streamed responses
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=0, lifespan="off", log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    app_client = httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}",
+        timeout=None,
+        limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    )
+    bench = Bench(app_client, github)
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        # Every other scenario needs signed-in users
+        await run_load(bench.login, args.users, args.concurrency)
+        for name in args.scenarios:
+            counts = {endpoint: len(values) for endpoint, values in bench.samples.items()}
+            errors = dict(bench.errors)
+            wall_time = await run_load(getattr(bench, name), args.requests, args.concurrency)
+            for endpoint, values in bench.samples.items():
+                new = values[counts.get(endpoint, 0):]
+                if new:
+                    results[endpoint] = summarize(new, bench.errors.get(endpoint, 0) - errors.get(endpoint, 0), wall_time)
+    finally:
+        await app_client.aclose()
+        server.should_exit = True
+        await serving
+        await main.github_client.aclose()
+        await main.ai_client.aclose()
+        main.stop_logging()
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "config": vars(args),
+        "results": results
+    }
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the CodeAtEase API against local stand-ins")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="operations per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=10, help="distinct signed-in users")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--github-latency", type=float, default=0.03, help="seconds per GitHub call")
+    parser.add_argument("--github-jitter", type=float, default=0.01)
+    parser.add_argument("--repos", type=int, default=250, help="repositories the users can see")
+    parser.add_argument("--per-page", type=int, default=100, help="largest page size the fake GitHub serves")
+    parser.add_argument("--tree-size", type=int, default=2000, help="files in the benchmark repository")
+    parser.add_argument("--files-per-dir", type=int, default=25)
+    parser.add_argument("--router-latency", type=float, default=0.5, help="seconds for a full completion")
+    parser.add_argument("--router-jitter", type=float, default=0.1)
+    parser.add_argument("--router-first-token", type=float, default=0.15, help="seconds to the first streamed token")
+    parser.add_argument("--router-503-rate", type=float, default=0.0, help="fraction of router calls answered with 503")
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier result file to compare against, or 'latest'")
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+def main_cli(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    baseline = load_baseline(args.baseline) if args.baseline else None
+    report = asyncio.run(run(args))
+    print_report(report["results"], baseline["results"] if baseline else None)
+
+    output = args.output or os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {output}")
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
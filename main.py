@@ -1,11 +1,12 @@
 from fastapi import FastAPI, HTTPException, Depends, status, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse, PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials, OAuth2PasswordBearer
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
 import httpx
 import os
+import sys
 from datetime import datetime, timedelta
 import jwt
 from passlib.context import CryptContext
@@ -13,19 +14,59 @@ from dotenv import load_dotenv
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from array import array
+from operator import itemgetter
+import hashlib
+import hmac
 import base64
 import json
 import asyncio
+import time
+import sqlite3
+import threading
+import re
+import contextvars
+import codecs
+import random
+import logging
+import queue
+import uuid
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, parse_qs
 
 load_dotenv()
 
 templates = Jinja2Templates(directory="templates")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared upstream clients on startup and close them on shutdown"""
+    get_github_client()
+    get_ai_client()
+    start_logging()
+    # Opening the session store can wait on another worker's migration
+    await asyncio.to_thread(session_store.prepare)
+    # Tokenizer loading can hit the network, so it never runs on the event loop
+    asyncio.get_running_loop().run_in_executor(None, load_tokenizer)
+    yield
+    cancel_prefetches()
+    cancel_search_builds()
+    cancel_summaries()
+    await close_github_client()
+    await close_ai_client()
+    stop_logging()
+
 # FastAPI App
 app = FastAPI(
     title="CodeAtEase API",
     description="AI-powered code editor with GitHub integration",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS Configuration
@@ -50,18 +91,97 @@ GITHUB_CLIENT_SECRET = os.getenv("GITHUB_CLIENT_SECRET")
 # Dynamic redirect URI based on BASE_URL
 GITHUB_REDIRECT_URI = os.getenv("GITHUB_REDIRECT_URI", f"{BASE_URL}/auth/github/callback")
 
+# GitHub HTTP client - one pooled client is shared by every route
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+GITHUB_HTTP2 = os.getenv("GITHUB_HTTP2", "true").lower() == "true"
+GITHUB_MAX_CONNECTIONS = int(os.getenv("GITHUB_MAX_CONNECTIONS", 100))
+GITHUB_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("GITHUB_MAX_KEEPALIVE_CONNECTIONS", 20))
+GITHUB_KEEPALIVE_EXPIRY = float(os.getenv("GITHUB_KEEPALIVE_EXPIRY", 30.0))
+GITHUB_TIMEOUT = float(os.getenv("GITHUB_TIMEOUT", 30.0))
+GITHUB_CONNECT_TIMEOUT = float(os.getenv("GITHUB_CONNECT_TIMEOUT", 10.0))
+# Conditional-request (ETag) cache for GitHub reads
+GITHUB_CACHE_MAX_BYTES = int(os.getenv("GITHUB_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# GitHub webhooks - repos that deliver signed push/delete/repository events are served from the
+# cache without revalidation for GITHUB_CACHE_FRESH_SECONDS; the webhooks invalidate what changed.
+# Kept short: no webhook fires when a token is revoked or loses access through team or org membership,
+# so this bounds how long such a token can still be served a cached private payload
+GITHUB_WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
+GITHUB_CACHE_FRESH_SECONDS = float(os.getenv("GITHUB_CACHE_FRESH_SECONDS", 10))
+WEBHOOK_SYNC_SECONDS = float(os.getenv("WEBHOOK_SYNC_SECONDS", 1.0))
+WEBHOOK_COVERAGE_SECONDS = float(os.getenv("WEBHOOK_COVERAGE_SECONDS", 7 * 24 * 3600))
+# Content-addressed blob cache - memory tier budget and optional disk spill directory
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR")
+BLOB_CACHE_DIR_MAX_BYTES = int(os.getenv("BLOB_CACHE_DIR_MAX_BYTES", 1024 * 1024 * 1024))
+# Raw file reads - larger files are not inlined as JSON; binary is sniffed from a prefix
+FILE_INLINE_MAX_BYTES = int(os.getenv("FILE_INLINE_MAX_BYTES", 1024 * 1024))
+RAW_SNIFF_BYTES = int(os.getenv("RAW_SNIFF_BYTES", 8000))
+RAW_CHUNK_BYTES = int(os.getenv("RAW_CHUNK_BYTES", 64 * 1024))
+# Batch file reads - files per request and GitHub fetches in flight for one batch
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 50))
+BATCH_FETCH_CONCURRENCY = int(os.getenv("BATCH_FETCH_CONCURRENCY", 8))
+# Maximum concurrent blob uploads per multi-file push
+GITHUB_WRITE_CONCURRENCY = int(os.getenv("GITHUB_WRITE_CONCURRENCY", 8))
+# Maximum concurrent page fetches when listing repositories
+GITHUB_PAGE_FANOUT = int(os.getenv("GITHUB_PAGE_FANOUT", 4))
+# Code search - memory budget across all repository indexes and per-repo limits
+SEARCH_INDEX_MAX_BYTES = int(os.getenv("SEARCH_INDEX_MAX_BYTES", 256 * 1024 * 1024))
+SEARCH_MAX_FILE_BYTES = int(os.getenv("SEARCH_MAX_FILE_BYTES", 512 * 1024))
+SEARCH_MAX_FILES = int(os.getenv("SEARCH_MAX_FILES", 5000))
+SEARCH_FETCH_CONCURRENCY = int(os.getenv("SEARCH_FETCH_CONCURRENCY", 8))
+SEARCH_REGEX_TIMEOUT_SECONDS = float(os.getenv("SEARCH_REGEX_TIMEOUT_SECONDS", 5))
+SEARCH_BUILD_BATCH_FILES = int(os.getenv("SEARCH_BUILD_BATCH_FILES", 200))
+# Prefetch - warm the blob cache with likely-opened files after a tree loads
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() in ("1", "true", "yes")
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", 2))
+PREFETCH_MAX_FILES = int(os.getenv("PREFETCH_MAX_FILES", 12))
+PREFETCH_MAX_FILE_BYTES = int(os.getenv("PREFETCH_MAX_FILE_BYTES", 256 * 1024))
+RECENT_FILES_PER_REPO = int(os.getenv("RECENT_FILES_PER_REPO", 10))
+
 #Huggingface Token
 HF_TOKEN = os.getenv("HF_TOKEN")
+HF_ROUTER_URL = os.getenv("HF_ROUTER_URL", "https://router.huggingface.co/v1/chat/completions")
+HF_MODEL = os.getenv("HF_MODEL", "Qwen/Qwen2.5-Coder-32B-Instruct")
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", 90.0))
+# Router resilience - retries share one deadline; the breaker opens after consecutive failures
+AI_DEADLINE = float(os.getenv("AI_DEADLINE", 60.0))
+AI_RETRY_ATTEMPTS = int(os.getenv("AI_RETRY_ATTEMPTS", 3))
+AI_RETRY_BASE_DELAY = float(os.getenv("AI_RETRY_BASE_DELAY", 0.5))
+AI_RETRY_MAX_DELAY = float(os.getenv("AI_RETRY_MAX_DELAY", 8.0))
+AI_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("AI_CIRCUIT_FAILURE_THRESHOLD", 5))
+AI_CIRCUIT_RESET_SECONDS = float(os.getenv("AI_CIRCUIT_RESET_SECONDS", 30.0))
+# Model response cache
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1024))
+# LLM dispatcher - upstream calls in flight at once, and how many may wait behind them
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 4))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 100))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 30))
+# Prompt context packing - token budget per request and the share kept back for history
+TOKENIZER_NAME = os.getenv("TOKENIZER_NAME", HF_MODEL)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 6000))
+PROMPT_HISTORY_RESERVE_TOKENS = int(os.getenv("PROMPT_HISTORY_RESERVE_TOKENS", 500))
+BLOB_TOKEN_CACHE_ENTRIES = int(os.getenv("BLOB_TOKEN_CACHE_ENTRIES", 512))
 
 # Security
 security = HTTPBearer()
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# In-memory storage
-users_db: Dict[int, Dict] = {}
-tokens_db: Dict[str, int] = {}
-chat_history: Dict[str, List[Dict]] = {}
+# Session storage - SQLite file shared by every worker on the host, fronted by a small LRU
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "codeatease.db")
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", 4096))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", 30))
+# Auth fast path - verified JWTs kept in memory; revocations shared through the session store
+AUTH_TOKEN_CACHE_ENTRIES = int(os.getenv("AUTH_TOKEN_CACHE_ENTRIES", 10000))
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", 1.0))
+MAX_CHAT_MESSAGES = 20
+# Chat memory - turns that age out of the ring are folded into a rolling summary of this size
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", 300))
+# Logging - records go through a bounded queue to a writer thread
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.1))
 
 # Helper function to get base URL from request
 def get_base_url(request: Request) -> str:
@@ -74,607 +194,3978 @@ def get_base_url(request: Request) -> str:
     host = request.headers.get("host", request.url.netloc)
     return f"{scheme}://{host}"
 
-# ==================== MODELS ====================
+# ==================== LOGGING ====================
 
-class User(BaseModel):
-    id: int
-    username: str
-    name: str
-    email: Optional[str] = None
-    avatar: str
+request_id_var = contextvars.ContextVar("request_id", default=None)
 
-class ChatMessage(BaseModel):
-    role: str
-    content: str
-    timestamp: str
-    fileContext: Optional[Dict[str, Any]] = None
+# Attributes every LogRecord has; anything else came in through ``extra``
+STANDARD_RECORD_FIELDS = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
 
-class AnalyzeRequest(BaseModel):
-    prompt: str
-    selectedCode: Optional[str] = ""
-    currentFile: Optional[Dict[str, Any]] = {}
-    repository: Optional[List[Dict[str, Any]]] = []
-    conversationHistory: Optional[List[Dict[str, Any]]] = []
+class JSONLogFormatter(logging.Formatter):
+    """One JSON object per line, with ``extra`` fields merged in"""
 
-class UpdateFileRequest(BaseModel):
-    owner: str
-    repo: str
-    path: str
-    content: str
-    message: str
-    sha: str
-    branch: Optional[str] = "main"
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_RECORD_FIELDS and key != "sample":
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
 
-class CreateFileRequest(BaseModel):
-    owner: str
-    repo: str
-    path: str
-    content: str
-    message: str
-    branch: Optional[str] = "main"
+class RequestContextFilter(logging.Filter):
+    """Stamp the correlation ID and drop sampled-out records before they are queued.
 
-class DeleteFileRequest(BaseModel):
-    owner: str
-    repo: str
-    path: str
-    message: str
-    sha: str
-    branch: Optional[str] = "main"
+    This runs in the logging coroutine, where the request's context is still
+    available; the writer thread has none.
+    """
 
-class RenameFileRequest(BaseModel):
-    owner: str
-    repo: str
-    oldPath: str
-    newPath: str
-    message: str
-    sha: str
-    branch: Optional[str] = "main"
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sample", False) and random.random() >= LOG_SAMPLE_RATE:
+            return False
+        request_id = request_id_var.get()
+        if request_id is not None and not hasattr(record, "request_id"):
+            record.request_id = request_id
+        return True
 
-class PushChangesRequest(BaseModel):
-    owner: str
-    repo: str
-    changes: List[Dict[str, Any]]
-    commitMessage: str
-    branch: Optional[str] = "main"
+class DroppingQueueHandler(QueueHandler):
+    """Never wait for the writer: when the queue is full the record is counted and dropped"""
 
-# ==================== AUTHENTICATION ====================
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    if "sub" in to_encode and isinstance(to_encode["sub"], int):
-        to_encode["sub"] = str(to_encode["sub"])
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    if not token:
-        raise HTTPException(status_code=401, detail="Token missing")
+log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+log_handler = DroppingQueueHandler(log_queue)
+log_handler.addFilter(RequestContextFilter())
+log_listener: Optional[QueueListener] = None
+
+logger = logging.getLogger("codeatease")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(log_handler)
+logger.propagate = False
+ai_logger = logger.getChild("ai")
+chat_logger = logger.getChild("chat")
+prefetch_logger = logger.getChild("prefetch")
+
+def start_logging():
+    """Start the thread that formats and writes queued records to stdout"""
+    global log_listener
+    if log_listener is None:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(JSONLogFormatter())
+        log_listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        log_listener.start()
+
+def stop_logging():
+    """Flush whatever is queued and stop the writer thread"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+# ==================== METRICS ====================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names: tuple, values: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+class Metric:
+    """One Prometheus metric family, values keyed by label values.
+
+    Values live in this process only; each worker exposes its own.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values: Dict[tuple, Any] = {}
+        metrics_registry.append(self)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, *label_values, value: float):
+        entry = self.values.get(label_values)
+        if entry is None:
+            # Per-bucket counts, then sum and count
+            entry = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+metrics_registry: List[Metric] = []
+
+http_request_seconds = Histogram("http_request_duration_seconds", "Request latency by route", ("method", "route", "status"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "Requests currently being served")
+github_requests = Counter("github_requests_total", "GitHub API calls by endpoint and status", ("method", "endpoint", "status"))
+github_request_seconds = Histogram("github_request_duration_seconds", "GitHub API latency to response headers", ("method", "endpoint"))
+github_rate_limit_remaining = Gauge("github_rate_limit_remaining", "Latest X-RateLimit-Remaining per token (hashed)", ("token",))
+llm_requests = Counter("llm_requests_total", "Model router calls by mode and status", ("mode", "status"))
+llm_request_seconds = Histogram("llm_request_duration_seconds", "Model router call latency", ("mode",))
+llm_first_token_seconds = Histogram("llm_time_to_first_token_seconds", "Time until the first streamed delta")
+llm_tokens = Counter("llm_tokens_total", "Tokens reported in the router's usage field", ("kind",))
+cache_hits = Gauge("cache_hits", "Hits per cache", ("cache",))
+cache_misses = Gauge("cache_misses", "Misses per cache", ("cache",))
+cache_hit_ratio = Gauge("cache_hit_ratio", "Hit ratio per cache", ("cache",))
+cache_bytes = Gauge("cache_bytes", "Bytes held per cache", ("cache",))
+in_flight = Gauge("in_flight", "In-flight work by kind", ("kind",))
+llm_queue_depth = Gauge("llm_queue_depth", "Chat requests waiting for an LLM slot")
+router_circuit_open = Gauge("router_circuit_open", "1 while the model router circuit is open")
+
+GITHUB_PATH_WORDS = {"git", "trees", "blobs", "commits", "refs", "ref", "heads", "branches", "user", "repos", "login", "oauth", "access_token"}
+
+def github_endpoint(url: httpx.URL) -> str:
+    """Collapse a GitHub URL to a low-cardinality template"""
+    parts = url.path.strip("/").split("/")
+    if len(parts) >= 3 and parts[0] == "repos":
+        parts = ["repos", "{owner}", "{repo}"] + parts[3:]
+    template = []
+    for part in parts:
+        if part in ("{owner}", "{repo}") or part in GITHUB_PATH_WORDS:
+            template.append(part)
+        elif template and template[-1] == "contents":
+            template.append("{path}")
+            break
+        elif part == "contents":
+            template.append(part)
+        else:
+            template.append("{id}")
+    return f"{url.host}/" + "/".join(template)
+
+async def github_request_started(request: httpx.Request):
+    request.extensions["started_at"] = time.perf_counter()
+
+async def github_response_received(response: httpx.Response):
+    request = response.request
+    endpoint = github_endpoint(request.url)
+    github_requests.inc(request.method, endpoint, response.status_code)
+    started_at = request.extensions.get("started_at")
+    if started_at is not None:
+        github_request_seconds.observe(request.method, endpoint, value=time.perf_counter() - started_at)
+    remaining = response.headers.get("x-ratelimit-remaining")
+    authorization = request.headers.get("authorization", "")
+    if remaining is not None and authorization:
+        github_rate_limit_remaining.set(hash_token(authorization.split()[-1])[:12], value=int(remaining))
+
+def record_llm_usage(usage: Optional[Dict[str, Any]]):
+    if not usage:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            llm_tokens.inc(kind.split("_")[0], amount=usage[kind])
+
+def collect_runtime_metrics():
+    """Copy the caches' and dispatcher's own counters into gauges at scrape time"""
+    caches = {"github": github_cache.stats(), "blob": blob_cache.stats(), "llm": llm_cache.stats()}
+    for name, stats in caches.items():
+        lookups = stats["hits"] + stats["misses"]
+        cache_hits.set(name, value=stats["hits"])
+        cache_misses.set(name, value=stats["misses"])
+        cache_hit_ratio.set(name, value=round(stats["hits"] / lookups, 4) if lookups else 0.0)
+        if "bytes" in stats:
+            cache_bytes.set(name, value=stats["bytes"])
+    cache_bytes.set("search_index", value=sum(index.size_bytes for index in search_indexes.indexes.values()))
+    in_flight.set("llm", value=llm_dispatcher.in_flight)
+    in_flight.set("github_interactive", value=interactive_github_calls)
+    in_flight.set("prefetch", value=len(prefetch_tasks))
+    llm_queue_depth.set(value=llm_dispatcher.waiting)
+    router_circuit_open.set(value=1 if router_circuit.is_open() else 0)
+
+def render_metrics() -> str:
+    collect_runtime_metrics()
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    """Assign the correlation ID and record latency for every request"""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    started_at = time.perf_counter()
+    http_requests_in_flight.inc(amount=1)
+    status_code = 500
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id_str = payload.get("sub")
-        if user_id_str is None:
-            raise HTTPException(status_code=401, detail="Invalid token payload")
-        user_id = int(user_id_str)
-        if user_id not in users_db:
-            raise HTTPException(status_code=401, detail="User not found")
-        return users_db[user_id]
-    except jwt.DecodeError:
-        raise HTTPException(status_code=401, detail="Token decode error")
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except ValueError:
-        raise HTTPException(status_code=401, detail="Invalid user ID format")
+        response = await call_next(request)
+        status_code = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        http_requests_in_flight.inc(amount=-1)
+        # The matched route's template keeps owner/repo/path out of the labels
+        route = request.scope.get("route")
+        http_request_seconds.observe(
+            request.method,
+            getattr(route, "path", "unmatched"),
+            status_code,
+            value=time.perf_counter() - started_at
+        )
 
-# ==================== TEMPLATE ROUTES ====================
+# ==================== GITHUB CLIENT ====================
 
-@app.get("/", response_class=HTMLResponse)
-async def root(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+github_client: Optional[httpx.AsyncClient] = None
 
-@app.get("/repo.html", response_class=HTMLResponse)
-async def repo_page(request: Request):
-    return templates.TemplateResponse("repo.html", {"request": request})
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional h2 package"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
 
-@app.get("/aipage.html", response_class=HTMLResponse)
-async def ai_page(request: Request):
-    return templates.TemplateResponse("aipage.html", {"request": request})
+def get_github_client() -> httpx.AsyncClient:
+    """Return the shared GitHub client, creating it on first use"""
+    global github_client
+    if github_client is None or github_client.is_closed:
+        github_client = httpx.AsyncClient(
+            http2=GITHUB_HTTP2 and _http2_available(),
+            limits=httpx.Limits(
+                max_connections=GITHUB_MAX_CONNECTIONS,
+                max_keepalive_connections=GITHUB_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=GITHUB_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(GITHUB_TIMEOUT, connect=GITHUB_CONNECT_TIMEOUT),
+            event_hooks={"request": [github_request_started], "response": [github_response_received]}
+        )
+    return github_client
 
-# API endpoint to get configuration
-@app.get("/api/config")
-async def get_config(request: Request):
-    """Return client configuration including base URL"""
-    base_url = get_base_url(request)
+async def close_github_client():
+    """Close the shared GitHub client and its pooled connections"""
+    global github_client
+    if github_client is not None:
+        await github_client.aclose()
+        github_client = None
+
+def github_headers(github_token: str) -> Dict[str, str]:
     return {
-        "baseUrl": base_url,
-        "environment": "production" if "render" in base_url or "railway" in base_url else "development"
+        "Authorization": f"token {github_token}",
+        "Accept": "application/vnd.github.v3+json"
     }
 
-# ==================== AUTH ROUTES ====================
+# Objects addressed by SHA never change, so their cached copies never need revalidating
+IMMUTABLE_GITHUB_PATH = re.compile(r"/git/(blobs|commits|trees)/[0-9a-f]{40}$")
 
-@app.get("/auth/github")
-async def github_login(request: Request):
-    """Redirect to GitHub OAuth"""
-    base_url = get_base_url(request)
-    redirect_uri = f"{base_url}/auth/github/callback"
-    
-    auth_url = (
-        f"https://github.com/login/oauth/authorize?"
-        f"client_id={GITHUB_CLIENT_ID}&"
-        f"redirect_uri={redirect_uri}&"
-        f"scope=repo,user"
-    )
-    return RedirectResponse(auth_url)
+def github_repo_key(url: str) -> Optional[str]:
+    """``owner/repo`` for a /repos/{owner}/{repo}/... API URL"""
+    parts = httpx.URL(url).path.strip("/").split("/")
+    if len(parts) >= 3 and parts[0] == "repos":
+        return f"{parts[1]}/{parts[2]}".lower()
+    return None
 
-@app.get("/auth/github/callback")
-async def github_callback(code: str, request: Request):
-    """Handle GitHub OAuth callback"""
-    if not code:
-        raise HTTPException(status_code=400, detail="No code provided")
-    
-    base_url = get_base_url(request)
-    redirect_uri = f"{base_url}/auth/github/callback"
-    
-    async with httpx.AsyncClient() as client:
-        token_response = await client.post(
-            "https://github.com/login/oauth/access_token",
-            headers={"Accept": "application/json"},
-            data={
-                "client_id": GITHUB_CLIENT_ID,
-                "client_secret": GITHUB_CLIENT_SECRET,
-                "code": code,
-                "redirect_uri": redirect_uri
-            }
-        )
-        
-        token_data = token_response.json()
-        github_access_token = token_data.get("access_token")
-        
-        if not github_access_token:
-            raise HTTPException(status_code=400, detail="Failed to get access token")
-        
-        user_response = await client.get(
-            "https://api.github.com/user",
-            headers={
-                "Authorization": f"token {github_access_token}",
-                "Accept": "application/json"
-            }
+class GitHubResponseCache:
+    """Byte-bounded LRU of GitHub validators (ETag/Last-Modified) and parsed payloads.
+
+    Entries are keyed per user token and URL, so a 304 can only ever replay a
+    payload the same token was allowed to read. ``by_repo`` indexes the keys of
+    each repository so webhook events can drop just the entries they affect.
+    """
+
+    def __init__(self, max_bytes: int, fresh_seconds: float):
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self.current_bytes = 0
+        self.entries: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self.by_repo: Dict[str, set] = {}
+        self.hits = 0
+        self.fresh_hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def make_key(github_token: str, url: str) -> tuple:
+        token_hash = hashlib.sha256(github_token.encode("utf-8")).hexdigest()[:16]
+        return (token_hash, url)
+
+    def get(self, key: tuple) -> Optional[Dict[str, Any]]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def is_fresh(self, key: tuple, entry: Dict[str, Any]) -> bool:
+        """Whether ``entry`` may be served without asking GitHub"""
+        url = httpx.URL(key[1])
+        if IMMUTABLE_GITHUB_PATH.search(url.path):
+            return True
+        repo_key = entry["repo_key"]
+        return (
+            repo_key is not None
+            and time.monotonic() - entry["stored_at"] < self.fresh_seconds
+            and repo_events.covers(repo_key)
         )
-        
-        user_data = user_response.json()
-        user_id = user_data["id"]
-        
-        # Handle None values from GitHub API
-        username = user_data.get("login", "unknown")
-        name = user_data.get("name") or username  # Use username if name is None
-        email = user_data.get("email") or ""
-        
-        users_db[user_id] = {
-            "id": user_id,
-            "username": username,
-            "name": name,  # This is now guaranteed to be a string
-            "email": email,
-            "avatar": username[:2].upper(),
-            "github_token": github_access_token,
-            "created_at": datetime.now().isoformat()
+
+    def revalidated(self, entry: Dict[str, Any]):
+        entry["stored_at"] = time.monotonic()
+
+    def put(
+        self,
+        key: tuple,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        payload: Any,
+        size: int,
+        link: Optional[str] = None
+    ):
+        if not etag and not last_modified:
+            return
+        if size > self.max_bytes:
+            self.discard(key)
+            return
+        self.discard(key)
+        repo_key = github_repo_key(key[1])
+        self.entries[key] = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "payload": payload,
+            "size": size,
+            "link": link,
+            "repo_key": repo_key,
+            "stored_at": time.monotonic()
         }
-        
-        jwt_token = create_access_token(data={"sub": user_id})
-        tokens_db[jwt_token] = user_id
-        
-        # Use base_url for redirect
-        redirect_url = f"{base_url}/repo.html?access_token={jwt_token}"
-        return RedirectResponse(redirect_url)
+        if repo_key is not None:
+            self.by_repo.setdefault(repo_key, set()).add(key)
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes and self.entries:
+            self.discard(next(iter(self.entries)))
 
-@app.get("/auth/user", response_model=User)
-async def get_current_user_info(current_user: dict = Depends(get_current_user)):
-    """Get current authenticated user"""
-    # Handle None values explicitly
-    username = current_user.get("username") or "unknown"
-    name = current_user.get("name") or current_user.get("username") or "Unknown User"
-    email = current_user.get("email") or ""
-    avatar = current_user.get("avatar") or current_user.get("avatar_url") or username[:2].upper()
-    
-    return User(
-        id=current_user.get("id"),
-        username=username,
-        name=name,
-        email=email,
-        avatar=avatar
+    def discard(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry["size"]
+            keys = self.by_repo.get(entry["repo_key"])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_repo[entry["repo_key"]]
+
+    def invalidate(self, repo_key: str, matches=None) -> int:
+        """Drop a repository's entries whose URL satisfies ``matches(url)``, or all of them"""
+        dropped = 0
+        for key in list(self.by_repo.get(repo_key, ())):
+            if matches is None or matches(httpx.URL(key[1])):
+                self.discard(key)
+                dropped += 1
+        self.invalidated += dropped
+        return dropped
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "fresh_hits": self.fresh_hits,
+            "misses": self.misses,
+            "invalidated": self.invalidated
+        }
+
+github_cache = GitHubResponseCache(GITHUB_CACHE_MAX_BYTES, GITHUB_CACHE_FRESH_SECONDS)
+
+# Background work marks itself so it can yield to calls made for a waiting user
+background_fetch = contextvars.ContextVar("background_fetch", default=False)
+interactive_github_calls = 0
+
+async def github_get(url: str, headers: Dict[str, str]) -> httpx.Response:
+    """GET through the shared client, counting calls made for a waiting user"""
+    client = get_github_client()
+    if background_fetch.get():
+        return await client.get(url, headers=headers)
+    global interactive_github_calls
+    interactive_github_calls += 1
+    try:
+        return await client.get(url, headers=headers)
+    finally:
+        interactive_github_calls -= 1
+
+async def github_get_json(
+    github_token: str,
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    parse=None
+):
+    """GET a GitHub JSON resource, revalidating cached copies with If-None-Match.
+
+    Returns ``(response, payload)``. ``payload`` is None when GitHub answered with
+    an error; a 304 replays the cached payload. Fresh entries (see
+    ``GitHubResponseCache.is_fresh``) are replayed without a request. ``parse``
+    optionally converts the decoded JSON before it is cached and returned.
+    """
+    request_url = str(httpx.URL(url, params=params)) if params else url
+    key = GitHubResponseCache.make_key(github_token, request_url)
+    headers = github_headers(github_token)
+
+    cached = github_cache.get(key)
+    if cached is not None and github_cache.is_fresh(key, cached):
+        github_cache.fresh_hits += 1
+        response = httpx.Response(200, request=httpx.Request("GET", request_url))
+        if cached["link"]:
+            response.headers["link"] = cached["link"]
+        return response, cached["payload"]
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = await github_get(request_url, headers)
+
+    if response.status_code == 304 and cached is not None:
+        github_cache.hits += 1
+        github_cache.revalidated(cached)
+        # Pagination callers still need the Link header of the original response
+        if cached["link"] and "link" not in response.headers:
+            response.headers["link"] = cached["link"]
+        return response, cached["payload"]
+
+    github_cache.misses += 1
+    if response.status_code != 200:
+        return response, None
+
+    payload = response.json()
+    if parse is not None:
+        payload = parse(payload)
+    github_cache.put(
+        key,
+        response.headers.get("etag"),
+        response.headers.get("last-modified"),
+        payload,
+        len(response.content),
+        response.headers.get("link")
     )
+    return response, payload
 
-@app.post("/auth/logout")
-async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Logout user"""
-    token = credentials.credentials
-    if token in tokens_db:
-        user_id = tokens_db[token]
-        if str(user_id) in chat_history:
-            del chat_history[str(user_id)]
-        del tokens_db[token]
-    return {"message": "Logged out successfully"}
+# ==================== BLOB CACHE ====================
 
-# ==================== REPOSITORY ROUTES ====================
-# [Keep all your existing repository routes - they're fine]
+def git_blob_sha(data: bytes) -> str:
+    """Compute the git object SHA of a blob"""
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
 
-@app.get("/api/repositories")
-async def get_repositories(current_user: dict = Depends(get_current_user)):
-    """Get all repositories for authenticated user"""
-    github_token = current_user["github_token"]
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            all_repos = []
-            page = 1
-            per_page = 100
-            
-            while True:
-                response = await client.get(
-                    "https://api.github.com/user/repos",
-                    headers={
-                        "Authorization": f"token {github_token}",
-                        "Accept": "application/vnd.github.v3+json"
-                    },
-                    params={
-                        "per_page": per_page,
-                        "page": page,
-                        "sort": "updated",
-                        "affiliation": "owner,collaborator,organization_member"
-                    }
-                )
-                
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=f"GitHub API error: {response.text}"
-                    )
-                
-                repos = response.json()
-                
-                if not repos:
-                    break
-                
-                all_repos.extend(repos)
-                
-                if len(repos) < per_page:
-                    break
-                
-                page += 1
-            
-            repositories = [{
-                "id": repo["id"],
-                "name": repo["name"],
-                "full_name": repo["full_name"],
-                "owner": repo["owner"]["login"],
-                "description": repo.get("description", ""),
-                "private": repo["private"],
-                "url": repo["html_url"],
-                "clone_url": repo["clone_url"],
-                "default_branch": repo.get("default_branch", "main"),
-                "language": repo.get("language", ""),
-                "stargazers_count": repo.get("stargazers_count", 0),
-                "forks_count": repo.get("forks_count", 0),
-                "updated_at": repo["updated_at"],
-                "created_at": repo["created_at"],
-                "size": repo.get("size", 0)
-            } for repo in all_repos]
-            
-            return {"repositories": repositories, "total": len(repositories)}
-        
-        except httpx.TimeoutException:
-            raise HTTPException(status_code=504, detail="GitHub API timeout")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to fetch repositories: {str(e)}")
-        
-@app.get("/api/repository/tree/{owner}/{repo}")
-async def get_repository_tree(owner: str, repo: str, current_user: dict = Depends(get_current_user)):
-    github_token = current_user["github_token"]
-    async with httpx.AsyncClient(timeout=30.0) as client:
+class BlobCache:
+    """Content-addressed cache of file contents keyed by git blob SHA.
+
+    A blob SHA never changes content, so entries are never revalidated. The
+    hottest blobs stay in memory under a byte budget and evicted blobs spill to
+    ``spill_dir`` when one is configured, under a second budget of
+    ``spill_max_bytes``. Each SHA records the repositories it was read from and
+    is only served for those repositories.
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: Optional[str] = None, spill_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.current_bytes = 0
+        self.memory: "OrderedDict[str, bytes]" = OrderedDict()
+        # sha -> size of the spilled files this process knows of, least recently used first
+        self.disk: "OrderedDict[str, int]" = OrderedDict()
+        self.disk_bytes = 0
+        self.repos: Dict[str, set] = {}
+        self.hits = 0
+        self.misses = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._adopt_spill()
+
+    def knows(self, sha: str, repo_key: str) -> bool:
+        return repo_key in self.repos.get(sha, ())
+
+    async def get(self, sha: str, repo_key: str) -> Optional[bytes]:
+        if not self.knows(sha, repo_key):
+            self.misses += 1
+            return None
+        data = self.memory.get(sha)
+        if data is not None:
+            self.memory.move_to_end(sha)
+            self.hits += 1
+            return data
+        if sha in self.disk:
+            data = await asyncio.to_thread(self._read_spill, sha)
+            if data is not None:
+                self.disk.move_to_end(sha)
+                await self._spill(self._store(sha, data))
+                self.hits += 1
+                return data
+            # Evicted by another worker sharing the directory
+            self._forget_spilled(sha)
+        self.misses += 1
+        return None
+
+    async def put(self, sha: str, data: bytes, repo_key: str) -> bool:
+        """Cache ``data`` under ``sha``; content that does not hash to ``sha`` is rejected"""
+        if git_blob_sha(data) != sha:
+            return False
+        self.repos.setdefault(sha, set()).add(repo_key)
+        if sha in self.memory:
+            self.memory.move_to_end(sha)
+            return True
+        await self._spill(self._store(sha, data))
+        return True
+
+    def _store(self, sha: str, data: bytes) -> List[tuple]:
+        evicted = []
+        if len(data) <= self.max_bytes:
+            self.memory[sha] = data
+            self.current_bytes += len(data)
+        else:
+            evicted.append((sha, data))
+        while self.current_bytes > self.max_bytes:
+            old_sha, old_data = self.memory.popitem(last=False)
+            self.current_bytes -= len(old_data)
+            evicted.append((old_sha, old_data))
+        if not self.spill_dir:
+            for old_sha, _ in evicted:
+                self.repos.pop(old_sha, None)
+        return evicted
+
+    async def _spill(self, evicted: List[tuple]):
+        if not self.spill_dir:
+            return
+        spilled = [(sha, data) for sha, data in evicted if len(data) <= self.spill_max_bytes]
+        if spilled:
+            await asyncio.to_thread(self._write_spill, spilled)
+        for sha, data in spilled:
+            if sha in self.disk:
+                self.disk.move_to_end(sha)
+            else:
+                self.disk[sha] = len(data)
+                self.disk_bytes += len(data)
+        doomed = []
+        while self.disk_bytes > self.spill_max_bytes:
+            sha, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            if sha not in self.memory:
+                self.repos.pop(sha, None)
+            doomed.append(sha)
+        if doomed:
+            await asyncio.to_thread(self._remove_spill, doomed)
+        for sha, _ in evicted:
+            # Blobs too large for the disk budget are gone once they leave memory
+            if sha not in self.disk and sha not in self.memory:
+                self.repos.pop(sha, None)
+
+    def _forget_spilled(self, sha: str):
+        self.disk_bytes -= self.disk.pop(sha, 0)
+        if sha not in self.memory:
+            self.repos.pop(sha, None)
+
+    def _spill_path(self, sha: str) -> str:
+        return os.path.join(self.spill_dir, sha[:2], sha)
+
+    def _read_spill(self, sha: str) -> Optional[bytes]:
         try:
-            repo_response = await client.get(
-                f"https://api.github.com/repos/{owner}/{repo}",
-                headers={"Authorization": f"token {github_token}", "Accept": "application/vnd.github.v3+json"}
-            )
-            if repo_response.status_code != 200:
-                raise HTTPException(status_code=404, detail="Repository not found")
-            repo_data = repo_response.json()
-            default_branch = repo_data.get("default_branch", "main")
-            tree_response = await client.get(
-                f"https://api.github.com/repos/{owner}/{repo}/git/trees/{default_branch}?recursive=1",
-                headers={"Authorization": f"token {github_token}", "Accept": "application/vnd.github.v3+json"}
-            )
-            if tree_response.status_code != 200:
-                raise HTTPException(status_code=404, detail="Failed to fetch repository tree")
-            tree_data = tree_response.json()
-            file_tree = build_tree_structure(tree_data["tree"])
-            return {"owner": owner, "repo": repo, "default_branch": default_branch, "tree": file_tree}
-        except httpx.TimeoutException:
-            raise HTTPException(status_code=504, detail="GitHub API timeout")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to fetch repository tree: {str(e)}")
+            with open(self._spill_path(sha), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        return data if git_blob_sha(data) == sha else None
+
+    def _write_spill(self, evicted: List[tuple]):
+        for sha, data in evicted:
+            path = self._spill_path(sha)
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _remove_spill(self, shas: List[str]):
+        for sha in shas:
+            try:
+                os.remove(self._spill_path(sha))
+            except OSError:
+                pass
+
+    def _adopt_spill(self):
+        """Count files left by earlier runs against the budget, oldest first, so they are evicted"""
+        found = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.is_dir():
+                for blob in os.scandir(entry.path):
+                    if blob.is_file() and not blob.name.endswith(".tmp"):
+                        stat = blob.stat()
+                        found.append((stat.st_mtime, blob.name, stat.st_size))
+        for _, sha, size in sorted(found):
+            self.disk[sha] = size
+            self.disk_bytes += size
+        doomed = []
+        while self.disk_bytes > self.spill_max_bytes:
+            sha, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            doomed.append(sha)
+        self._remove_spill(doomed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.memory),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "spill_dir": self.spill_dir,
+            "disk_entries": len(self.disk),
+            "disk_bytes": self.disk_bytes,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+blob_cache = BlobCache(BLOB_CACHE_MAX_BYTES, BLOB_CACHE_DIR, BLOB_CACHE_DIR_MAX_BYTES)
+
+# Repositories each user has successfully read through this process
+repo_access: Dict[int, set] = {}
+
+def grant_repo_access(user_id: int, repo_key: str):
+    repo_access.setdefault(user_id, set()).add(repo_key)
+
+def has_repo_access(user_id: int, repo_key: str) -> bool:
+    return repo_key in repo_access.get(user_id, ())
+
+def decode_blob_text(data: bytes) -> str:
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return "[Binary file - cannot display]"
+
+async def read_blob(github_token: str, owner: str, repo: str, sha: str) -> bytes:
+    """Return a blob's bytes from the blob cache, fetching it from GitHub on a miss.
+
+    The cache does not check the caller's access; routes serving the bytes
+    back to a user go through ``has_repo_access`` or ``fetch_blob``.
+    """
+    data = await blob_cache.get(sha, f"{owner}/{repo}")
+    if data is not None:
+        return data
+    return await fetch_blob(github_token, owner, repo, sha)
+
+async def fetch_blob(github_token: str, owner: str, repo: str, sha: str) -> bytes:
+    """Read a blob from GitHub under ``github_token`` and keep it in the blob cache"""
+    repo_key = f"{owner}/{repo}"
+    # Blobs are immutable and kept by SHA in the blob cache, so they skip the ETag cache
+    response = await github_get(
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/blobs/{sha}",
+        dict(github_headers(github_token), Accept="application/vnd.github.raw+json")
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=404, detail=f"Blob not found: {sha}")
+    data = response.content
+    await blob_cache.put(sha, data, repo_key)
+    return data
+
+# ==================== GIT DATA API ====================
+
+async def create_blob(github_token: str, owner: str, repo: str, data: bytes) -> str:
+    """Upload a blob and return its SHA"""
+    client = get_github_client()
+    response = await client.post(
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/blobs",
+        headers=github_headers(github_token),
+        json={"content": base64.b64encode(data).decode("utf-8"), "encoding": "base64"}
+    )
+    if response.status_code != 201:
+        raise HTTPException(status_code=400, detail=f"Failed to create blob: {response.text}")
+    return response.json()["sha"]
+
+async def get_branch_head(github_token: str, owner: str, repo: str, branch: str) -> Dict[str, str]:
+    """Resolve a branch to its head commit SHA and that commit's root tree SHA"""
+    client = get_github_client()
+    ref_response = await client.get(
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/ref/heads/{branch}",
+        headers=github_headers(github_token)
+    )
+    if ref_response.status_code != 200:
+        raise HTTPException(status_code=404, detail=f"Branch not found: {branch}")
+    commit_sha = ref_response.json()["object"]["sha"]
+
+    # Commits are immutable, so the ETag cache can always replay them
+    _, commit_data = await github_get_json(
+        github_token,
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/commits/{commit_sha}"
+    )
+    if commit_data is None:
+        raise HTTPException(status_code=404, detail="Failed to fetch head commit")
+    return {"commit": commit_sha, "tree": commit_data["tree"]["sha"]}
+
+async def commit_tree_changes(
+    github_token: str,
+    owner: str,
+    repo: str,
+    branch: str,
+    head: Dict[str, str],
+    tree_entries: List[Dict[str, Any]],
+    message: str
+) -> Dict[str, str]:
+    """Write ``tree_entries`` on top of ``head`` as one commit and fast-forward the branch"""
+    client = get_github_client()
+    tree_response = await client.post(
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/trees",
+        headers=github_headers(github_token),
+        json={"base_tree": head["tree"], "tree": tree_entries}
+    )
+    if tree_response.status_code != 201:
+        raise HTTPException(status_code=400, detail=f"Failed to create tree: {tree_response.text}")
+    tree_sha = tree_response.json()["sha"]
+
+    commit_response = await client.post(
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/commits",
+        headers=github_headers(github_token),
+        json={"message": message, "tree": tree_sha, "parents": [head["commit"]]}
+    )
+    if commit_response.status_code != 201:
+        raise HTTPException(status_code=400, detail=f"Failed to create commit: {commit_response.text}")
+    commit_sha = commit_response.json()["sha"]
+
+    ref_response = await client.patch(
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/refs/heads/{branch}",
+        headers=github_headers(github_token),
+        json={"sha": commit_sha, "force": False}
+    )
+    if ref_response.status_code == 422:
+        raise HTTPException(status_code=409, detail=f"Branch {branch} moved during the commit, please retry")
+    if ref_response.status_code != 200:
+        raise HTTPException(status_code=400, detail=f"Failed to update branch: {ref_response.text}")
+    await forget_branch_changes(owner, repo, branch, [entry["path"] for entry in tree_entries])
+    return {"commit": commit_sha, "tree": tree_sha}
+
+# ==================== FILE EDITS ====================
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+def split_lines(text: str) -> List[str]:
+    """Split on newlines only, keeping them, the way diff tools count lines"""
+    lines = text.split("\n")
+    result = [line + "\n" for line in lines[:-1]]
+    if lines[-1]:
+        result.append(lines[-1])
+    return result
+
+def apply_unified_diff(base: str, diff: str) -> str:
+    """Apply a unified diff to ``base``; raises ValueError if any hunk does not match"""
+    lines = split_lines(base)
+    diff_lines = split_lines(diff)
+    out: List[str] = []
+    pos = 0
+    i = 0
+    hunks = 0
+    while i < len(diff_lines):
+        header = HUNK_HEADER.match(diff_lines[i])
+        i += 1
+        if not header:
+            continue  # ---/+++ file headers and anything else outside a hunk
+        hunks += 1
+        old_start, old_count = int(header.group(1)), int(header.group(2) or 1)
+        start = old_start - 1 if old_count else old_start
+        if start < pos or start > len(lines):
+            raise ValueError(f"hunk {hunks} is out of order or past the end of the file")
+        out.extend(lines[pos:start])
+        pos = start
+        consumed = 0
+        last = None
+        while i < len(diff_lines) and not diff_lines[i].startswith("@@"):
+            line = diff_lines[i]
+            i += 1
+            tag, text = line[:1], line[1:]
+            if line in ("\n", "\r\n"):
+                tag, text = " ", line  # a blank context line whose leading space was trimmed
+            if tag == "\\":
+                # "\ No newline at end of file" - only matters for a line being added
+                if last == "+" and out:
+                    out[-1] = out[-1].rstrip("\r\n")
+                continue
+            if tag in (" ", "-"):
+                if pos >= len(lines) or lines[pos].rstrip("\r\n") != text.rstrip("\r\n"):
+                    raise ValueError(f"hunk {hunks} does not match line {pos + 1}")
+                if tag == " ":
+                    out.append(lines[pos])
+                pos += 1
+                consumed += 1
+            elif tag == "+":
+                out.append(text)
+            else:
+                raise ValueError(f"unexpected line in hunk {hunks}: {line[:40]!r}")
+            last = tag
+        if consumed != old_count:
+            raise ValueError(f"hunk {hunks} covers {consumed} lines, header says {old_count}")
+    if not hunks:
+        raise ValueError("diff has no hunks")
+    out.extend(lines[pos:])
+    return "".join(out)
+
+def apply_text_edits(base: str, edits: List[Dict[str, Any]]) -> str:
+    """Apply ``{"offset", "deleteCount", "text"}`` edits, all positioned against ``base``.
+
+    Offsets count UTF-16 code units, as JavaScript string indices do.
+    """
+    units = base.encode("utf-16-le")
+    parts = []
+    pos = 0
+    for edit in sorted(edits, key=lambda edit: int(edit["offset"])):
+        offset, delete_count = int(edit["offset"]), int(edit.get("deleteCount", 0))
+        if offset < pos or delete_count < 0 or (offset + delete_count) * 2 > len(units):
+            raise ValueError("edits overlap or fall outside the file")
+        parts.append(units[pos * 2:offset * 2])
+        parts.append((edit.get("text") or "").encode("utf-16-le"))
+        pos = offset + delete_count
+    parts.append(units[pos * 2:])
+    # An edit that splits a surrogate pair leaves invalid UTF-16 and fails here
+    return b"".join(parts).decode("utf-16-le")
+
+async def resolve_new_content(github_token: str, owner: str, repo: str, change: Dict[str, Any]) -> bytes:
+    """New bytes for a change sent as full ``content``, or as a ``diff`` or ``edits`` against the blob ``sha``.
+
+    The base comes from the blob cache, so a small edit to a large file does
+    not need the file uploaded again.
+    """
+    given = [field for field in ("content", "diff", "edits") if change.get(field) is not None]
+    if len(given) != 1:
+        raise HTTPException(status_code=400, detail="Send exactly one of content, diff or edits")
+    if given[0] == "content":
+        return change["content"].encode("utf-8")
+    if not change.get("sha"):
+        raise HTTPException(status_code=400, detail="A diff or edits need the base blob sha")
+    
+    base = await read_blob(github_token, owner, repo, change["sha"])
+    try:
+        text = base.decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Binary files can only be updated with full content")
+    try:
+        if given[0] == "diff":
+            text = apply_unified_diff(text, change["diff"])
+        else:
+            text = apply_text_edits(text, change["edits"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise HTTPException(status_code=422, detail=f"Edit does not apply to {change['sha'][:7]}: {e}")
+    return text.encode("utf-8")
+
+# ==================== REPOSITORY TREES ====================
+
+class CompactTree:
+    """A GitHub tree listing stored as parallel arrays.
+
+    Entry ``i`` is described by ``paths[i]``, ``kinds[i]`` (blob/tree/commit),
+    ``modes[i]``, ``shas[i]`` and ``sizes[i]``; ``children[i]`` lists the entries
+    directly below it and ``roots`` the top-level ones. ``index`` maps a path to
+    its entry. This replaces a nested dict per entry, so the ETag cache keeps
+    this instead of the raw JSON.
+    """
+
+    __slots__ = ("sha", "truncated", "paths", "kinds", "modes", "shas", "sizes", "children", "roots", "index")
+
+    def __init__(self, sha: Optional[str], truncated: bool = False):
+        self.sha = sha
+        self.truncated = truncated
+        self.paths: List[str] = []
+        self.kinds: List[str] = []
+        self.modes: List[str] = []
+        self.shas: List[str] = []
+        self.sizes = array("q")
+        self.children: List[List[int]] = []
+        self.roots: List[int] = []
+        self.index: Dict[str, int] = {}
+
+    @classmethod
+    def from_payload(cls, payload: Dict[str, Any]) -> "CompactTree":
+        """Build from a /git/trees response"""
+        tree = cls(payload.get("sha"), payload.get("truncated", False))
+        # A parent path always sorts before the paths below it
+        for item in sorted(payload.get("tree", []), key=itemgetter("path")):
+            path = item["path"]
+            entry = len(tree.paths)
+            tree.paths.append(path)
+            tree.kinds.append(item["type"])
+            tree.modes.append(item.get("mode", "100644"))
+            tree.shas.append(item.get("sha"))
+            tree.sizes.append(item.get("size") or 0)
+            tree.children.append([])
+            tree.index[path] = entry
+            parent_path = path.rpartition("/")[0]
+            if not parent_path:
+                tree.roots.append(entry)
+            elif parent_path in tree.index:
+                tree.children[tree.index[parent_path]].append(entry)
+        return tree
+
+    def node(self, entry: int, lazy: bool = False, prefix: str = "") -> Dict[str, Any]:
+        path = self.paths[entry]
+        node = {"name": path.rpartition("/")[2], "path": f"{prefix}/{path}" if prefix else path}
+        if self.kinds[entry] == "tree":
+            node["type"] = "folder"
+            node["children"] = []
+            node["expanded"] = False
+            if lazy:
+                # Children are fetched on demand by tree SHA
+                node["sha"] = self.shas[entry]
+                node["lazy"] = True
+                node["loaded"] = False
+        else:
+            node["type"] = "file"
+            node["sha"] = self.shas[entry]
+            node["size"] = self.sizes[entry]
+        return node
+
+    def to_nested(self) -> List[Dict]:
+        """Render the nested folder/file structure the editor expects"""
+        def build(entry: int) -> Dict[str, Any]:
+            node = self.node(entry)
+            if "children" in node:
+                node["children"] = [build(child) for child in self.children[entry]]
+            return node
+        return [build(entry) for entry in self.roots]
+
+    def level(self, prefix: str = "") -> List[Dict]:
+        """Render only the top level, with folders left to be expanded lazily.
+
+        A non-recursive listing of a subdirectory has bare names, so ``prefix``
+        (the directory's own path) is prepended to each node path.
+        """
+        return [self.node(entry, lazy=True, prefix=prefix) for entry in self.roots]
+
+    def diff(self, base: "CompactTree") -> List[Dict]:
+        """List what changed between ``base`` and this tree, both recursive.
+
+        Folders whose SHA did not change are skipped without visiting their
+        contents. Changed entries are rendered like lazy nodes with a
+        ``status`` of added or modified; a removed folder is reported once,
+        not per descendant.
+        """
+        changes = []
+
+        def walk(entries: List[int]):
+            for entry in entries:
+                path = self.paths[entry]
+                base_entry = base.index.get(path)
+                if base_entry is None:
+                    status = "added"
+                elif base.shas[base_entry] != self.shas[entry] or base.modes[base_entry] != self.modes[entry]:
+                    status = "modified"
+                else:
+                    continue
+                changes.append(dict(self.node(entry, lazy=True), status=status))
+                if self.kinds[entry] == "tree":
+                    walk(self.children[entry])
+
+        def walk_removed(entries: List[int]):
+            for entry in entries:
+                path = base.paths[entry]
+                current = self.index.get(path)
+                if current is None:
+                    changes.append({"status": "removed", "path": path})
+                elif base.kinds[entry] == "tree" and base.shas[entry] != self.shas[current]:
+                    walk_removed(base.children[entry])
+
+        walk(self.roots)
+        walk_removed(base.roots)
+        changes.sort(key=itemgetter("path"))
+        return changes
+
+async def get_compact_tree(
+    github_token: str,
+    owner: str,
+    repo: str,
+    tree_ref: str,
+    recursive: bool = True
+) -> CompactTree:
+    """Fetch a tree by branch name or SHA as a CompactTree"""
+    _, tree = await github_get_json(
+        github_token,
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/trees/{tree_ref}",
+        params={"recursive": 1} if recursive else None,
+        parse=CompactTree.from_payload
+    )
+    if tree is None:
+        raise HTTPException(status_code=404, detail="Failed to fetch repository tree")
+    return tree
+
+async def resolve_tree_entry(
+    github_token: str,
+    owner: str,
+    repo: str,
+    tree_sha: str,
+    path: str
+) -> Optional[Dict[str, str]]:
+    """Look one path up by walking non-recursive listings down from ``tree_sha``.
+
+    Each listing is a single directory, so this stays exact where a recursive
+    listing of the whole repository comes back truncated. Returns the entry's
+    ``kind``, ``mode`` and ``sha``, or None when the path does not exist.
+    """
+    parts = path.strip("/").split("/")
+    current = tree_sha
+    for depth, name in enumerate(parts):
+        listing = await get_compact_tree(github_token, owner, repo, current, recursive=False)
+        entry = listing.index.get(name)
+        if entry is None:
+            if listing.truncated:
+                directory = "/".join(parts[:depth]) or "/"
+                raise HTTPException(status_code=400, detail=f"Directory {directory} is too large to look up {path}")
+            return None
+        if depth == len(parts) - 1:
+            return {"kind": listing.kinds[entry], "mode": listing.modes[entry], "sha": listing.shas[entry]}
+        if listing.kinds[entry] != "tree":
+            return None
+        current = listing.shas[entry]
+    return None
+
+# ==================== CODE SEARCH ====================
+
+def trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def regex_literals(pattern: str) -> List[str]:
+    """Extract literal runs every match of ``pattern`` must contain.
+
+    This is deliberately conservative: alternation, ``(?`` constructs
+    (inline flags, named or non-capturing groups, lookarounds) and escapes
+    that take arguments (``\\x41``, ``\\u0041``, ``\\N{...}``, octal and
+    backreferences) give up entirely, and any character made optional by a
+    quantifier ends the current run.
+    """
+    if "|" in pattern or "(?" in pattern or re.search(r"\)[?*{]", pattern):
+        return []
+    runs, current = [], []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern):
+            escaped = pattern[i + 1]
+            i += 2
+            if escaped in "xuUN" or escaped.isdigit():
+                return []
+            if escaped.isalnum():
+                runs.append("".join(current))
+                current = []
+            else:
+                current.append(escaped)
+            continue
+        if char in "?*{":
+            if current:
+                current.pop()
+            runs.append("".join(current))
+            current = []
+            if char == "{":
+                i = pattern.find("}", i) + 1 or len(pattern)
+                continue
+        elif char == "[":
+            runs.append("".join(current))
+            current = []
+            i += 1
+            if pattern[i:i + 1] == "^":
+                i += 1
+            # A "]" first in the class is a member, and so is an escaped one
+            if pattern[i:i + 1] == "]":
+                i += 1
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            i += 1
+            continue
+        elif char in ".^$+()":
+            runs.append("".join(current))
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    runs.append("".join(current))
+    return [run for run in runs if len(run) >= 3]
+
+class TrigramIndex:
+    """Case-folded trigram index over the text files of one repository"""
+
+    def __init__(self, repo_key: str):
+        self.repo_key = repo_key
+        self.tree_sha: Optional[str] = None
+        self.paths: List[Optional[str]] = []
+        self.shas: List[Optional[str]] = []
+        self.texts: List[Optional[str]] = []
+        self.doc_ids: Dict[str, int] = {}
+        self.free_ids: List[int] = []
+        self.postings: Dict[str, set] = {}
+        self.size_bytes = 0
+        self.lock = asyncio.Lock()
+        # path -> blob SHA on the indexed tree that is not in the index yet
+        self.pending: Dict[str, str] = {}
+        self.build_task: Optional[asyncio.Task] = None
+
+    def add_blob(self, path: str, sha: str, data: bytes):
+        """Index ``data`` if it is text"""
+        if b"\0" in data[:8000]:
+            return
+        try:
+            self.add(path, sha, data.decode("utf-8"))
+        except UnicodeDecodeError:
+            pass
+
+    def add(self, path: str, sha: str, text: str):
+        self.remove(path)
+        doc_id = self.free_ids.pop() if self.free_ids else len(self.paths)
+        if doc_id == len(self.paths):
+            self.paths.append(None)
+            self.shas.append(None)
+            self.texts.append(None)
+        self.paths[doc_id] = path
+        self.shas[doc_id] = sha
+        self.texts[doc_id] = text
+        self.doc_ids[path] = doc_id
+        grams = trigrams(text.lower())
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(doc_id)
+        # Text plus roughly one set slot per posting
+        self.size_bytes += len(text) + 64 * len(grams)
+
+    def remove(self, path: str):
+        doc_id = self.doc_ids.pop(path, None)
+        if doc_id is None:
+            return
+        text = self.texts[doc_id]
+        grams = trigrams(text.lower())
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is not None:
+                posting.discard(doc_id)
+                if not posting:
+                    del self.postings[gram]
+        self.size_bytes -= len(text) + 64 * len(grams)
+        self.paths[doc_id] = self.shas[doc_id] = self.texts[doc_id] = None
+        self.free_ids.append(doc_id)
+
+    def candidates(self, literals: List[str]):
+        """Documents containing every trigram of every literal; None means all documents"""
+        result = None
+        for literal in literals:
+            for gram in trigrams(literal.lower()):
+                posting = self.postings.get(gram, set())
+                result = set(posting) if result is None else result & posting
+                if not result:
+                    return set()
+        return result
+
+    def search(self, query: str, regex: bool = False, case_sensitive: bool = False, limit: int = 50) -> List[Dict]:
+        flags = 0 if case_sensitive else re.IGNORECASE
+        pattern = re.compile(query if regex else re.escape(query), flags)
+        doc_ids = self.candidates(regex_literals(query) if regex else [query])
+        if doc_ids is None:
+            doc_ids = set(self.doc_ids.values())
+        
+        results = []
+        folded_query = query.lower()
+        for doc_id in doc_ids:
+            text = self.texts[doc_id]
+            matches = []
+            count = 0
+            for match in pattern.finditer(text):
+                count += 1
+                if len(matches) < 5:
+                    line_start = text.rfind("\n", 0, match.start()) + 1
+                    line_end = text.find("\n", match.start())
+                    matches.append({
+                        "line": text.count("\n", 0, match.start()) + 1,
+                        "text": text[line_start:line_end if line_end >= 0 else len(text)][:200]
+                    })
+                if count >= 100:
+                    break
+            if not count:
+                continue
+            path = self.paths[doc_id]
+            # Files whose path mentions the query rank above files that only contain it
+            score = count + (50 if not regex and folded_query in path.lower() else 0)
+            results.append({"path": path, "sha": self.shas[doc_id], "score": score, "matches": matches})
+        
+        results.sort(key=lambda r: (-r["score"], r["path"]))
+        return results[:limit]
+
+class SearchIndexRegistry:
+    """Repository indexes, evicted least-recently-used first once over a byte budget"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.indexes: "OrderedDict[str, TrigramIndex]" = OrderedDict()
+
+    def get(self, repo_key: str) -> Optional[TrigramIndex]:
+        index = self.indexes.get(repo_key)
+        if index is not None:
+            self.indexes.move_to_end(repo_key)
+        return index
+
+    def get_or_create(self, repo_key: str) -> TrigramIndex:
+        index = self.get(repo_key)
+        if index is None:
+            index = self.indexes[repo_key] = TrigramIndex(repo_key)
+        return index
+
+    def drop(self, repo_key: str):
+        self.indexes.pop(repo_key, None)
+
+    def enforce_budget(self):
+        while sum(index.size_bytes for index in self.indexes.values()) > self.max_bytes and len(self.indexes) > 1:
+            self.indexes.popitem(last=False)
+
+search_indexes = SearchIndexRegistry(SEARCH_INDEX_MAX_BYTES)
+search_build_tasks: set = set()
+
+def search_in_child(index: TrigramIndex, query: str, case_sensitive: bool, limit: int, sender):
+    sender.send(index.search(query, regex=True, case_sensitive=case_sensitive, limit=limit))
+    sender.close()
+
+async def run_search(index: TrigramIndex, query: str, regex: bool, case_sensitive: bool, limit: int) -> List[Dict]:
+    """Search ``index`` without holding up the event loop.
+
+    Python's regex engine keeps the GIL for a whole match, so a thread cannot
+    stop a pattern that backtracks catastrophically. Regex searches run in a
+    forked child, which sees the index without copying it and is killed after
+    ``SEARCH_REGEX_TIMEOUT_SECONDS``.
+    """
+    if not regex or "fork" not in multiprocessing.get_all_start_methods():
+        async with index.lock:
+            return await asyncio.to_thread(index.search, query, regex, case_sensitive, limit)
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=search_in_child, args=(index, query, case_sensitive, limit, sender))
+    process.start()
+    sender.close()
+    try:
+        if not await asyncio.to_thread(receiver.poll, SEARCH_REGEX_TIMEOUT_SECONDS):
+            raise HTTPException(status_code=422, detail="Regular expression took too long to run")
+        return await asyncio.to_thread(receiver.recv)
+    except EOFError:
+        raise HTTPException(status_code=500, detail="Search failed")
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.kill()
+        await asyncio.to_thread(process.join)
+
+async def ensure_search_index(github_token: str, owner: str, repo: str) -> TrigramIndex:
+    """Bring a repository's index up to date with its default branch.
+
+    Only blobs whose SHA changed since the last build are re-indexed. Those
+    already in the blob cache are indexed at once; the rest are left in
+    ``index.pending`` for a background build, so a first search over a large
+    repository answers from a partial index instead of spending the user's
+    rate limit while they wait.
+    """
+    repo_key = f"{owner}/{repo}"
+    _, repo_data = await github_get_json(github_token, f"{GITHUB_API_URL}/repos/{owner}/{repo}")
+    if repo_data is None:
+        raise HTTPException(status_code=404, detail="Repository not found")
+    tree = await get_compact_tree(github_token, owner, repo, repo_data.get("default_branch", "main"))
+    
+    index = search_indexes.get_or_create(repo_key)
+    async with index.lock:
+        if index.tree_sha != tree.sha:
+            await refresh_search_index(index, tree)
+    
+    if index.pending:
+        schedule_index_build(github_token, owner, repo, index)
+    search_indexes.enforce_budget()
+    return index
+
+async def refresh_search_index(index: TrigramIndex, tree: CompactTree):
+    """Point ``index`` at ``tree``, indexing what the blob cache already holds; callers hold ``index.lock``"""
+    wanted = {}
+    for path, kind, mode, sha, size in zip(tree.paths, tree.kinds, tree.modes, tree.shas, tree.sizes):
+        if kind == "blob" and mode != "120000" and size <= SEARCH_MAX_FILE_BYTES:
+            wanted[path] = sha
+            if len(wanted) >= SEARCH_MAX_FILES:
+                break
+    
+    for path in list(index.doc_ids):
+        if wanted.get(path) != index.shas[index.doc_ids[path]]:
+            index.remove(path)
+    
+    index.pending = {}
+    for path, sha in wanted.items():
+        if path in index.doc_ids:
+            continue
+        data = await blob_cache.get(sha, index.repo_key)
+        if data is None:
+            index.pending[path] = sha
+        else:
+            index.add_blob(path, sha, data)
+    index.tree_sha = tree.sha
+
+def schedule_index_build(github_token: str, owner: str, repo: str, index: TrigramIndex):
+    """Start fetching a batch of the index's pending blobs without awaiting it"""
+    if index.build_task is not None and not index.build_task.done():
+        return
+    task = asyncio.create_task(build_search_index(github_token, owner, repo, index))
+    index.build_task = task
+    search_build_tasks.add(task)
+    task.add_done_callback(search_build_tasks.discard)
+
+async def build_search_index(github_token: str, owner: str, repo: str, index: TrigramIndex):
+    """Fetch up to ``SEARCH_BUILD_BATCH_FILES`` pending blobs; later searches continue the build"""
+    background_fetch.set(True)
+    semaphore = asyncio.Semaphore(SEARCH_FETCH_CONCURRENCY)
+    
+    async def load(path: str, sha: str):
+        async with semaphore:
+            await wait_for_interactive_calls()
+            try:
+                data = await read_blob(github_token, owner, repo, sha)
+            except Exception:
+                data = None
+        async with index.lock:
+            # The tree may have moved on while the blob was in flight
+            if index.pending.get(path) != sha:
+                return
+            # A blob that fails to fetch is dropped rather than retried by every search
+            del index.pending[path]
+            if data is not None:
+                index.add_blob(path, sha, data)
+    
+    await asyncio.gather(*(load(path, sha) for path, sha in list(index.pending.items())[:SEARCH_BUILD_BATCH_FILES]))
+    search_indexes.enforce_budget()
+
+def cancel_search_builds():
+    for task in list(search_build_tasks):
+        task.cancel()
+
+def related_snippets(repo_key: str, text: str, exclude_path: Optional[str] = None, max_files: int = 3) -> List[str]:
+    """Pull short snippets from other files that mention identifiers in ``text``.
+
+    Only an index that already exists is consulted - chat never waits for a build.
+    """
+    index = search_indexes.get(repo_key)
+    if index is None or not text:
+        return []
+    identifiers = sorted(set(re.findall(r"[A-Za-z_][A-Za-z0-9_]{3,}", text)), key=len, reverse=True)[:5]
+    seen = set()
+    snippets = []
+    for identifier in identifiers:
+        for result in index.search(identifier, case_sensitive=True, limit=max_files):
+            if result["path"] == exclude_path or result["path"] in seen:
+                continue
+            seen.add(result["path"])
+            lines = "\n".join(f"{m['line']}: {m['text']}" for m in result["matches"][:3])
+            snippets.append(f"`{result['path']}`\n```\n{lines}\n```")
+            if len(snippets) >= max_files:
+                return snippets
+    return snippets
+
+# ==================== PREFETCH ====================
+
+README_NAMES = ("readme", "readme.md", "readme.rst", "readme.txt")
+MANIFEST_NAMES = (
+    "package.json", "requirements.txt", "pyproject.toml", "setup.py", "setup.cfg",
+    "Cargo.toml", "go.mod", "pom.xml", "build.gradle", "Gemfile", "composer.json", "Dockerfile"
+)
+SOURCE_EXTENSIONS = (
+    ".py", ".js", ".ts", ".tsx", ".jsx", ".go", ".rs", ".java", ".rb", ".php",
+    ".c", ".cc", ".cpp", ".h", ".cs", ".swift", ".kt", ".html", ".css"
+)
+
+# (user_id, repo_key) -> path -> blob SHA, most recently opened last
+recent_files: Dict[tuple, "OrderedDict[str, str]"] = {}
+prefetch_semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+prefetch_tasks: set = set()
+prefetch_running: set = set()
+prefetch_stats = {"scheduled": 0, "fetched": 0, "skipped": 0, "failed": 0}
+
+def remember_opened_file(user_id: int, repo_key: str, path: str, sha: str):
+    files = recent_files.setdefault((user_id, repo_key), OrderedDict())
+    files.pop(path, None)
+    files[path] = sha
+    while len(files) > RECENT_FILES_PER_REPO:
+        files.popitem(last=False)
+
+def prefetch_candidates(tree: CompactTree, repo_key: str, recent: Optional["OrderedDict[str, str]"] = None, lazy: bool = False) -> List[tuple]:
+    """Pick ``(path, sha)`` pairs worth warming, most likely to be opened first.
+
+    The user's own recent files come first, then README and manifest files,
+    then top-level source files.
+    """
+    picked: Dict[str, str] = {}
+
+    def consider(path: str, sha: Optional[str], size: int = 0):
+        if sha and path not in picked and size <= PREFETCH_MAX_FILE_BYTES and not blob_cache.knows(sha, repo_key):
+            picked[path] = sha
+
+    for path, sha in reversed((recent or {}).items()):
+        entry = tree.index.get(path)
+        if entry is not None:
+            if tree.kinds[entry] == "blob":
+                consider(path, tree.shas[entry], tree.sizes[entry])
+        elif (lazy and "/" in path) or tree.truncated:
+            # A lazy tree only lists the top level, so trust the SHA seen at open time
+            consider(path, sha)
+
+    top_level = [entry for entry in tree.roots if tree.kinds[entry] == "blob" and tree.modes[entry] != "120000"]
+    for entry in top_level:
+        if tree.paths[entry].lower() in README_NAMES or tree.paths[entry] in MANIFEST_NAMES:
+            consider(tree.paths[entry], tree.shas[entry], tree.sizes[entry])
+    for entry in top_level:
+        if tree.paths[entry].endswith(SOURCE_EXTENSIONS):
+            consider(tree.paths[entry], tree.shas[entry], tree.sizes[entry])
+
+    return list(picked.items())[:PREFETCH_MAX_FILES]
+
+async def wait_for_interactive_calls(max_wait: float = 5.0):
+    """Hold background fetches back while a user is waiting on GitHub"""
+    deadline = time.monotonic() + max_wait
+    while interactive_github_calls > 0 and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+async def run_prefetch(github_token: str, owner: str, repo: str, files: List[tuple]):
+    background_fetch.set(True)
+    repo_key = f"{owner}/{repo}"
+
+    async def fetch(path: str, sha: str):
+        async with prefetch_semaphore:
+            if blob_cache.knows(sha, repo_key):
+                prefetch_stats["skipped"] += 1
+                return
+            await wait_for_interactive_calls()
+            try:
+                await read_blob(github_token, owner, repo, sha)
+                prefetch_stats["fetched"] += 1
+            except Exception as e:
+                prefetch_stats["failed"] += 1
+                prefetch_logger.warning("Prefetch failed", extra={"repo": repo_key, "path": path, "error": str(e)})
+
+    await asyncio.gather(*(fetch(path, sha) for path, sha in files))
+
+def schedule_prefetch(github_token: str, user_id: int, owner: str, repo: str, tree: CompactTree, lazy: bool = False):
+    """Start warming the blob cache for a freshly loaded tree without awaiting it"""
+    repo_key = f"{owner}/{repo}"
+    job_key = (user_id, repo_key)
+    if not PREFETCH_ENABLED or job_key in prefetch_running:
+        return
+    files = prefetch_candidates(tree, repo_key, recent_files.get(job_key), lazy)
+    if not files:
+        return
+    prefetch_stats["scheduled"] += len(files)
+    prefetch_running.add(job_key)
+    task = asyncio.create_task(run_prefetch(github_token, owner, repo, files))
+    prefetch_tasks.add(task)
+
+    def finished(done):
+        prefetch_tasks.discard(done)
+        prefetch_running.discard(job_key)
+
+    task.add_done_callback(finished)
+
+def cancel_prefetches():
+    for task in list(prefetch_tasks):
+        task.cancel()
+
+# ==================== SESSION STORE ====================
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+class SessionStore(ABC):
+    """Storage for users, issued tokens and chat history.
+
+    Every worker process must see the same data, so backends keep it outside
+    the process. Chat history is keyed by the stringified user id. Writes may
+    wait on another worker, so async callers run them with ``asyncio.to_thread``.
+    """
+
+    def prepare(self):
+        """Set up this process's storage; may block, so run it off the event loop"""
+
+    @abstractmethod
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_user(self, user: Dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_token(self, token: str, user_id: int):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_token_user(self, token: str) -> Optional[int]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_token(self, token: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def revoke_token(self, token_hash: str, expires_at: float):
+        """Record that a token must no longer be accepted, until it would have expired anyway"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def revoked_since(self, cursor: int) -> List[tuple]:
+        """Revocations recorded after ``cursor`` as ``(cursor, token_hash, expires_at)`` rows"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def record_repo_event(self, repo_key: str, event: Dict, retention_seconds: float) -> int:
+        """Append a webhook event for every worker to apply; returns its cursor"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def repo_events_since(self, cursor: int) -> List[tuple]:
+        """Events recorded after ``cursor`` as ``(cursor, repo_key, event, received_at)`` rows"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_chat(self, user_id: str) -> List[Dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def append_chat(self, user_id: str, messages: List[Dict], max_messages: int) -> tuple:
+        """Append messages to a ring of ``max_messages`` slots.
+
+        Messages pushed out of the ring are queued for summarization. Returns
+        the ring contents and the number of messages waiting to be summarized.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_chat_summary(self, user_id: str) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_chat_memory(self, user_id: str) -> Optional[Dict]:
+        """The summary, the last seq folded into it and the evicted messages still pending"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def fold_chat_summary(self, user_id: str, summary: str, base_seq: int, through_seq: int) -> bool:
+        """Store ``summary`` as covering everything up to ``through_seq``.
+
+        Only applies if the stored summary still covers ``base_seq``, so a
+        worker that summarized a stale snapshot cannot overwrite a newer one.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear_chat(self, user_id: str):
+        raise NotImplementedError
+
+class SQLiteSessionStore(SessionStore):
+    """SessionStore backed by a SQLite database in WAL mode.
+
+    WAL lets every worker read while one writes. Connections are opened lazily
+    per process so a pre-forking server never shares one across workers.
+    Reads and writes use separate connections: a write can wait on another
+    worker's transaction for the full busy timeout, and reads on the event
+    loop must not queue behind it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        self._write_conn: Optional[sqlite3.Connection] = None
+        self._write_pid: Optional[int] = None
+        self._write_lock = threading.Lock()
+
+    def prepare(self):
+        with self._write_lock:
+            self.write_connection()
+
+    def connection(self) -> sqlite3.Connection:
+        """This process's read connection.
+
+        WAL readers do not wait for writers, so the busy timeout is short.
+        """
+        if self._conn is None or self._pid != os.getpid():
+            if self._write_conn is None or self._write_pid != os.getpid():
+                # The schema is created by the write connection
+                with self._write_lock:
+                    self.write_connection()
+            self._conn = sqlite3.connect(self.path, timeout=1.0, check_same_thread=False, isolation_level=None)
+            self._pid = os.getpid()
+        return self._conn
+
+    def write_connection(self) -> sqlite3.Connection:
+        """This process's write connection; callers hold ``_write_lock``"""
+        if self._write_conn is None or self._write_pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tokens "
+                "(token_hash TEXT PRIMARY KEY, user_id INTEGER NOT NULL, created_at TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_ring "
+                "(user_id TEXT NOT NULL, slot INTEGER NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL, "
+                "PRIMARY KEY (user_id, slot))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_memory "
+                "(user_id TEXT PRIMARY KEY, next_seq INTEGER NOT NULL, summary TEXT NOT NULL, "
+                "summarized_seq INTEGER NOT NULL, pending TEXT NOT NULL, updated_at TEXT NOT NULL)"
+            )
+            self.migrate_chat_history(conn)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS revoked_tokens "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, token_hash TEXT UNIQUE NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS repo_events "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, repo_key TEXT NOT NULL, event TEXT NOT NULL, received_at REAL NOT NULL)"
+            )
+            self._write_conn = conn
+            self._write_pid = os.getpid()
+        return self._write_conn
+
+    def migrate_chat_history(self, conn: sqlite3.Connection):
+        """Move histories from the old one-JSON-list-per-user table into the ring"""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_history'"
+            ).fetchone()
+            if exists:
+                for user_id, messages in conn.execute("SELECT user_id, messages FROM chat_history").fetchall():
+                    messages = json.loads(messages)
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO chat_ring (user_id, slot, seq, message) VALUES (?, ?, ?, ?)",
+                        [(user_id, seq, seq, json.dumps(message)) for seq, message in enumerate(messages)]
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO chat_memory VALUES (?, ?, '', -1, '[]', ?)",
+                        (user_id, len(messages), datetime.now().isoformat())
+                    )
+                conn.execute("DROP TABLE chat_history")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            row = self.connection().execute("SELECT data FROM users WHERE id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_user(self, user: Dict):
+        with self._write_lock:
+            self.write_connection().execute(
+                "INSERT OR REPLACE INTO users (id, data) VALUES (?, ?)",
+                (user["id"], json.dumps(user))
+            )
+
+    def add_token(self, token: str, user_id: int):
+        with self._write_lock:
+            self.write_connection().execute(
+                "INSERT OR REPLACE INTO tokens (token_hash, user_id, created_at) VALUES (?, ?, ?)",
+                (hash_token(token), user_id, datetime.now().isoformat())
+            )
+
+    def get_token_user(self, token: str) -> Optional[int]:
+        with self._lock:
+            row = self.connection().execute(
+                "SELECT user_id FROM tokens WHERE token_hash = ?", (hash_token(token),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def delete_token(self, token: str):
+        with self._write_lock:
+            self.write_connection().execute("DELETE FROM tokens WHERE token_hash = ?", (hash_token(token),))
+
+    def revoke_token(self, token_hash: str, expires_at: float):
+        with self._write_lock:
+            conn = self.write_connection()
+            conn.execute(
+                "INSERT OR IGNORE INTO revoked_tokens (token_hash, expires_at) VALUES (?, ?)",
+                (token_hash, expires_at)
+            )
+            # Expired tokens fail signature checks on their own, so their revocations can go
+            conn.execute("DELETE FROM revoked_tokens WHERE expires_at < ?", (time.time(),))
+
+    def revoked_since(self, cursor: int) -> List[tuple]:
+        with self._lock:
+            return self.connection().execute(
+                "SELECT id, token_hash, expires_at FROM revoked_tokens WHERE id > ? ORDER BY id", (cursor,)
+            ).fetchall()
+
+    def record_repo_event(self, repo_key: str, event: Dict, retention_seconds: float) -> int:
+        with self._write_lock:
+            conn = self.write_connection()
+            cursor = conn.execute(
+                "INSERT INTO repo_events (repo_key, event, received_at) VALUES (?, ?, ?)",
+                (repo_key, json.dumps(event), time.time())
+            ).lastrowid
+            conn.execute("DELETE FROM repo_events WHERE received_at < ?", (time.time() - retention_seconds,))
+        return cursor
+
+    def repo_events_since(self, cursor: int) -> List[tuple]:
+        with self._lock:
+            rows = self.connection().execute(
+                "SELECT id, repo_key, event, received_at FROM repo_events WHERE id > ? ORDER BY id", (cursor,)
+            ).fetchall()
+        return [(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def get_chat(self, user_id: str) -> List[Dict]:
+        with self._lock:
+            return self._ring(self.connection(), user_id)
+
+    def _ring(self, conn: sqlite3.Connection, user_id: str) -> List[Dict]:
+        rows = conn.execute("SELECT message FROM chat_ring WHERE user_id = ? ORDER BY seq", (user_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def append_chat(self, user_id: str, messages: List[Dict], max_messages: int) -> tuple:
+        with self._write_lock:
+            conn = self.write_connection()
+            # BEGIN IMMEDIATE takes the write lock up front so concurrent workers cannot lose a turn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT next_seq, summary, summarized_seq, pending FROM chat_memory WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                next_seq, summary, summarized_seq, pending = row if row else (0, "", -1, "[]")
+                pending = json.loads(pending)
+                for message in messages:
+                    slot = next_seq % max_messages
+                    old = conn.execute(
+                        "SELECT seq, message FROM chat_ring WHERE user_id = ? AND slot = ?", (user_id, slot)
+                    ).fetchone()
+                    if old:
+                        pending.append({"seq": old[0], "message": json.loads(old[1])})
+                    conn.execute(
+                        "INSERT OR REPLACE INTO chat_ring (user_id, slot, seq, message) VALUES (?, ?, ?, ?)",
+                        (user_id, slot, next_seq, json.dumps(message))
+                    )
+                    next_seq += 1
+                # Rows left outside the window by a smaller max_messages age out the same way
+                for seq, message in conn.execute(
+                    "SELECT seq, message FROM chat_ring WHERE user_id = ? AND seq < ? ORDER BY seq",
+                    (user_id, next_seq - max_messages)
+                ).fetchall():
+                    pending.append({"seq": seq, "message": json.loads(message)})
+                conn.execute("DELETE FROM chat_ring WHERE user_id = ? AND seq < ?", (user_id, next_seq - max_messages))
+                # If summaries keep failing the backlog stays bounded; the oldest turns are dropped unsummarized
+                pending = sorted(pending, key=lambda item: item["seq"])[-max_messages:]
+                conn.execute(
+                    "INSERT OR REPLACE INTO chat_memory VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, next_seq, summary, summarized_seq, json.dumps(pending), datetime.now().isoformat())
+                )
+                history = self._ring(conn, user_id)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return history, len(pending)
+
+    def get_chat_summary(self, user_id: str) -> str:
+        with self._lock:
+            row = self.connection().execute(
+                "SELECT summary FROM chat_memory WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else ""
+
+    def get_chat_memory(self, user_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self.connection().execute(
+                "SELECT summary, summarized_seq, pending FROM chat_memory WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if not row:
+            return None
+        return {"summary": row[0], "summarized_seq": row[1], "pending": json.loads(row[2])}
+
+    def fold_chat_summary(self, user_id: str, summary: str, base_seq: int, through_seq: int) -> bool:
+        with self._write_lock:
+            conn = self.write_connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT summarized_seq, pending FROM chat_memory WHERE user_id = ?", (user_id,)
+                ).fetchone()
+                applied = bool(row) and row[0] == base_seq
+                if applied:
+                    pending = [item for item in json.loads(row[1]) if item["seq"] > through_seq]
+                    conn.execute(
+                        "UPDATE chat_memory SET summary = ?, summarized_seq = ?, pending = ?, updated_at = ? "
+                        "WHERE user_id = ?",
+                        (summary, through_seq, json.dumps(pending), datetime.now().isoformat(), user_id)
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return applied
+
+    def clear_chat(self, user_id: str):
+        with self._write_lock:
+            conn = self.write_connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM chat_ring WHERE user_id = ?", (user_id,))
+                # Sequence numbers keep counting so a summary still in flight for the old conversation is rejected
+                conn.execute(
+                    "UPDATE chat_memory SET summary = '', summarized_seq = next_seq - 1, pending = '[]', updated_at = ? "
+                    "WHERE user_id = ?",
+                    (datetime.now().isoformat(), user_id)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+class CachedSessionStore(SessionStore):
+    """Read-through LRU in front of another SessionStore.
+
+    Users and token lookups are cached for ``ttl_seconds``; writes from this
+    process go through to the backend and update the cache. Chat memory is
+    never cached because any worker may append to it. Writes run on worker
+    threads, so the LRU is guarded by a lock.
+    """
+
+    def __init__(self, backend: SessionStore, max_entries: int, ttl_seconds: float):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, key: tuple, load):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self.entries.move_to_end(key)
+                return entry[1]
+        value = load()
+        if value is not None:
+            self._set(key, value)
+        return value
+
+    def _set(self, key: tuple, value: Any):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def prepare(self):
+        self.backend.prepare()
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        return self._get(("user", user_id), lambda: self.backend.get_user(user_id))
+
+    def put_user(self, user: Dict):
+        self.backend.put_user(user)
+        self._set(("user", user["id"]), user)
+
+    def add_token(self, token: str, user_id: int):
+        self.backend.add_token(token, user_id)
+        self._set(("token", hash_token(token)), user_id)
+
+    def get_token_user(self, token: str) -> Optional[int]:
+        return self._get(("token", hash_token(token)), lambda: self.backend.get_token_user(token))
+
+    def delete_token(self, token: str):
+        self.backend.delete_token(token)
+        with self.lock:
+            self.entries.pop(("token", hash_token(token)), None)
+
+    def revoke_token(self, token_hash: str, expires_at: float):
+        self.backend.revoke_token(token_hash, expires_at)
+
+    def revoked_since(self, cursor: int) -> List[tuple]:
+        return self.backend.revoked_since(cursor)
+
+    def record_repo_event(self, repo_key: str, event: Dict, retention_seconds: float) -> int:
+        return self.backend.record_repo_event(repo_key, event, retention_seconds)
+
+    def repo_events_since(self, cursor: int) -> List[tuple]:
+        return self.backend.repo_events_since(cursor)
+
+    def get_chat(self, user_id: str) -> List[Dict]:
+        return self.backend.get_chat(user_id)
+
+    def append_chat(self, user_id: str, messages: List[Dict], max_messages: int) -> tuple:
+        return self.backend.append_chat(user_id, messages, max_messages)
+
+    def get_chat_summary(self, user_id: str) -> str:
+        return self.backend.get_chat_summary(user_id)
+
+    def get_chat_memory(self, user_id: str) -> Optional[Dict]:
+        return self.backend.get_chat_memory(user_id)
+
+    def fold_chat_summary(self, user_id: str, summary: str, base_seq: int, through_seq: int) -> bool:
+        return self.backend.fold_chat_summary(user_id, summary, base_seq, through_seq)
+
+    def clear_chat(self, user_id: str):
+        self.backend.clear_chat(user_id)
+
+session_store: SessionStore = CachedSessionStore(
+    SQLiteSessionStore(SESSION_DB_PATH),
+    SESSION_CACHE_MAX_ENTRIES,
+    SESSION_CACHE_TTL_SECONDS
+)
+
+# ==================== MODELS ====================
+
+class User(BaseModel):
+    id: int
+    username: str
+    name: str
+    email: Optional[str] = None
+    avatar: str
+
+class ChatMessage(BaseModel):
+    role: str
+    content: str
+    timestamp: str
+    fileContext: Optional[Dict[str, Any]] = None
+
+class AnalyzeRequest(BaseModel):
+    prompt: str
+    selectedCode: Optional[str] = ""
+    currentFile: Optional[Dict[str, Any]] = {}
+    repository: Optional[List[Dict[str, Any]]] = []
+    conversationHistory: Optional[List[Dict[str, Any]]] = []
+    noCache: Optional[bool] = False
+    owner: Optional[str] = None
+    repo: Optional[str] = None
+
+class UpdateFileRequest(BaseModel):
+    owner: str
+    repo: str
+    path: str
+    message: str
+    sha: str
+    branch: Optional[str] = "main"
+    # Exactly one of: the whole new content, a unified diff or edits against ``sha``
+    content: Optional[str] = None
+    diff: Optional[str] = None
+    edits: Optional[List[Dict[str, Any]]] = None
+
+class CreateFileRequest(BaseModel):
+    owner: str
+    repo: str
+    path: str
+    content: str
+    message: str
+    branch: Optional[str] = "main"
+
+class DeleteFileRequest(BaseModel):
+    owner: str
+    repo: str
+    path: str
+    message: str
+    sha: str
+    branch: Optional[str] = "main"
+
+class RenameFileRequest(BaseModel):
+    owner: str
+    repo: str
+    oldPath: str
+    newPath: str
+    message: str
+    sha: Optional[str] = None
+    branch: Optional[str] = "main"
+
+class BatchFilesRequest(BaseModel):
+    # Each entry has a ``path``, a blob ``sha`` or both
+    files: List[Dict[str, Any]]
+
+class PushChangesRequest(BaseModel):
+    owner: str
+    repo: str
+    changes: List[Dict[str, Any]]
+    commitMessage: str
+    branch: Optional[str] = "main"
+
+# ==================== AUTHENTICATION ====================
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    to_encode = data.copy()
+    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    to_encode.update({"exp": expire})
+    if "sub" in to_encode and isinstance(to_encode["sub"], int):
+        to_encode["sub"] = str(to_encode["sub"])
+    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return encoded_jwt
+
+class VerifiedTokenCache:
+    """LRU of JWTs whose signature has already been checked.
+
+    Entries keep the token's own expiry, so a cached token stops working at
+    the same moment a freshly decoded one would.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, token: str) -> Optional[tuple]:
+        entry = self.entries.get(token)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self.entries[token]
+            return None
+        self.entries.move_to_end(token)
+        return entry
+
+    def put(self, token: str, user_id: int, expires_at: float, token_hash: str):
+        self.entries[token] = (user_id, expires_at, token_hash)
+        self.entries.move_to_end(token)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def discard(self, token: str):
+        self.entries.pop(token, None)
+
+class RevocationSet:
+    """This process's copy of the revoked-token list in the session store.
+
+    Lookups are a set membership test; the copy pulls new revocations from
+    the store at most every ``sync_seconds``, so a logout in another worker
+    takes effect there within that window.
+    """
+
+    def __init__(self, store: SessionStore, sync_seconds: float):
+        self.store = store
+        self.sync_seconds = sync_seconds
+        self.revoked: Dict[str, float] = {}
+        self.cursor = 0
+        self.next_sync = 0.0
+
+    def sync(self):
+        for cursor, token_hash, expires_at in self.store.revoked_since(self.cursor):
+            self.revoked[token_hash] = expires_at
+            self.cursor = cursor
+        now = time.time()
+        for token_hash in [h for h, expires_at in self.revoked.items() if expires_at < now]:
+            del self.revoked[token_hash]
+        self.next_sync = time.monotonic() + self.sync_seconds
+
+    def is_revoked(self, token_hash: str) -> bool:
+        if time.monotonic() >= self.next_sync:
+            self.sync()
+        return token_hash in self.revoked
+
+    async def revoke(self, token_hash: str, expires_at: float):
+        await asyncio.to_thread(self.store.revoke_token, token_hash, expires_at)
+        self.revoked[token_hash] = expires_at
+
+def token_expiry(payload: Dict[str, Any]) -> float:
+    return payload.get("exp") or time.time() + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+
+verified_tokens = VerifiedTokenCache(AUTH_TOKEN_CACHE_ENTRIES)
+revoked_tokens = RevocationSet(session_store, REVOCATION_SYNC_SECONDS)
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    if not token:
+        raise HTTPException(status_code=401, detail="Token missing")
+    try:
+        cached = verified_tokens.get(token)
+        if cached is not None:
+            user_id, _, token_hash = cached
+        else:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            user_id_str = payload.get("sub")
+            if user_id_str is None:
+                raise HTTPException(status_code=401, detail="Invalid token payload")
+            user_id = int(user_id_str)
+            token_hash = hash_token(token)
+            verified_tokens.put(token, user_id, token_expiry(payload), token_hash)
+        if revoked_tokens.is_revoked(token_hash):
+            raise HTTPException(status_code=401, detail="Token revoked")
+        user = session_store.get_user(user_id)
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        return user
+    except jwt.DecodeError:
+        raise HTTPException(status_code=401, detail="Token decode error")
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except ValueError:
+        raise HTTPException(status_code=401, detail="Invalid user ID format")
+
+# ==================== TEMPLATE ROUTES ====================
+
+@app.get("/", response_class=HTMLResponse)
+async def root(request: Request):
+    return templates.TemplateResponse("index.html", {"request": request})
+
+@app.get("/repo.html", response_class=HTMLResponse)
+async def repo_page(request: Request):
+    return templates.TemplateResponse("repo.html", {"request": request})
+
+@app.get("/aipage.html", response_class=HTMLResponse)
+async def ai_page(request: Request):
+    return templates.TemplateResponse("aipage.html", {"request": request})
+
+# API endpoint to get configuration
+@app.get("/api/config")
+async def get_config(request: Request):
+    """Return client configuration including base URL"""
+    base_url = get_base_url(request)
+    return {
+        "baseUrl": base_url,
+        "environment": "production" if "render" in base_url or "railway" in base_url else "development"
+    }
+
+# ==================== AUTH ROUTES ====================
+
+@app.get("/auth/github")
+async def github_login(request: Request):
+    """Redirect to GitHub OAuth"""
+    base_url = get_base_url(request)
+    redirect_uri = f"{base_url}/auth/github/callback"
+    
+    auth_url = (
+        f"https://github.com/login/oauth/authorize?"
+        f"client_id={GITHUB_CLIENT_ID}&"
+        f"redirect_uri={redirect_uri}&"
+        f"scope=repo,user"
+    )
+    return RedirectResponse(auth_url)
+
+@app.get("/auth/github/callback")
+async def github_callback(code: str, request: Request):
+    """Handle GitHub OAuth callback"""
+    if not code:
+        raise HTTPException(status_code=400, detail="No code provided")
+    
+    base_url = get_base_url(request)
+    redirect_uri = f"{base_url}/auth/github/callback"
+    
+    client = get_github_client()
+    token_response = await client.post(
+        "https://github.com/login/oauth/access_token",
+        headers={"Accept": "application/json"},
+        data={
+            "client_id": GITHUB_CLIENT_ID,
+            "client_secret": GITHUB_CLIENT_SECRET,
+            "code": code,
+            "redirect_uri": redirect_uri
+        }
+    )
+        
+    token_data = token_response.json()
+    github_access_token = token_data.get("access_token")
+        
+    if not github_access_token:
+        raise HTTPException(status_code=400, detail="Failed to get access token")
+        
+    user_response = await client.get(
+        f"{GITHUB_API_URL}/user",
+        headers={
+            "Authorization": f"token {github_access_token}",
+            "Accept": "application/json"
+        }
+    )
+        
+    user_data = user_response.json()
+    user_id = user_data["id"]
+        
+    # Handle None values from GitHub API
+    username = user_data.get("login", "unknown")
+    name = user_data.get("name") or username  # Use username if name is None
+    email = user_data.get("email") or ""
+        
+    await asyncio.to_thread(session_store.put_user, {
+        "id": user_id,
+        "username": username,
+        "name": name,  # This is now guaranteed to be a string
+        "email": email,
+        "avatar": username[:2].upper(),
+        "github_token": github_access_token,
+        "created_at": datetime.now().isoformat()
+    })
+        
+    jwt_token = create_access_token(data={"sub": user_id})
+    await asyncio.to_thread(session_store.add_token, jwt_token, user_id)
+        
+    # Use base_url for redirect
+    redirect_url = f"{base_url}/repo.html?access_token={jwt_token}"
+    return RedirectResponse(redirect_url)
+
+@app.get("/auth/user", response_model=User)
+async def get_current_user_info(current_user: dict = Depends(get_current_user)):
+    """Get current authenticated user"""
+    # Handle None values explicitly
+    username = current_user.get("username") or "unknown"
+    name = current_user.get("name") or current_user.get("username") or "Unknown User"
+    email = current_user.get("email") or ""
+    avatar = current_user.get("avatar") or current_user.get("avatar_url") or username[:2].upper()
+    
+    return User(
+        id=current_user.get("id"),
+        username=username,
+        name=name,
+        email=email,
+        avatar=avatar
+    )
+
+@app.post("/auth/logout")
+async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Logout user"""
+    token = credentials.credentials
+    user_id = session_store.get_token_user(token)
+    if user_id is not None:
+        await asyncio.to_thread(session_store.clear_chat, str(user_id))
+        await asyncio.to_thread(session_store.delete_token, token)
+    try:
+        # Only tokens this server signed are worth revoking
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        await revoked_tokens.revoke(hash_token(token), token_expiry(payload))
+    except jwt.InvalidTokenError:
+        pass
+    verified_tokens.discard(token)
+    return {"message": "Logged out successfully"}
+
+# ==================== REPOSITORY ROUTES ====================
+# [Keep all your existing repository routes - they're fine]
+
+def format_repository(repo: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": repo["id"],
+        "name": repo["name"],
+        "full_name": repo["full_name"],
+        "owner": repo["owner"]["login"],
+        "description": repo.get("description", ""),
+        "private": repo["private"],
+        "url": repo["html_url"],
+        "clone_url": repo["clone_url"],
+        "default_branch": repo.get("default_branch", "main"),
+        "language": repo.get("language", ""),
+        "stargazers_count": repo.get("stargazers_count", 0),
+        "forks_count": repo.get("forks_count", 0),
+        "updated_at": repo["updated_at"],
+        "created_at": repo["created_at"],
+        "size": repo.get("size", 0)
+    }
+
+async def fetch_repository_page(github_token: str, page: int, per_page: int = 100):
+    """Fetch one page of the user's repositories"""
+    response, repos = await github_get_json(
+        github_token,
+        f"{GITHUB_API_URL}/user/repos",
+        params={
+            "per_page": per_page,
+            "page": page,
+            "sort": "updated",
+            "affiliation": "owner,collaborator,organization_member"
+        }
+    )
+    if repos is None:
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"GitHub API error: {response.text}"
+        )
+    return response, repos
+
+def last_page_number(response: httpx.Response) -> int:
+    """Read the last page number from a GitHub Link header"""
+    last = response.links.get("last")
+    if not last:
+        return 1
+    try:
+        return int(httpx.URL(last["url"]).params.get("page", 1))
+    except ValueError:
+        return 1
+
+async def stream_repository_pages(first_repos: List[Dict], page_tasks: List[asyncio.Task]):
+    """Yield repositories as NDJSON, page by page in sort order"""
+    try:
+        yield "".join(json.dumps(format_repository(repo)) + "\n" for repo in first_repos)
+        for task in page_tasks:
+            repos = await task
+            yield "".join(json.dumps(format_repository(repo)) + "\n" for repo in repos)
+    except Exception as e:
+        yield json.dumps({"error": str(getattr(e, "detail", e))}) + "\n"
+    finally:
+        for task in page_tasks:
+            task.cancel()
+
+@app.get("/api/repositories")
+async def get_repositories(stream: bool = False, current_user: dict = Depends(get_current_user)):
+    """Get all repositories for authenticated user"""
+    github_token = current_user["github_token"]
+    
+    try:
+        # The first page's Link header tells us how many pages remain
+        first_response, first_repos = await fetch_repository_page(github_token, 1)
+        last_page = last_page_number(first_response)
+        
+        semaphore = asyncio.Semaphore(GITHUB_PAGE_FANOUT)
+        
+        async def fetch_page(page: int) -> List[Dict]:
+            async with semaphore:
+                _, repos = await fetch_repository_page(github_token, page)
+                return repos
+        
+        page_tasks = [asyncio.ensure_future(fetch_page(page)) for page in range(2, last_page + 1)]
+        
+        if stream:
+            return StreamingResponse(
+                stream_repository_pages(first_repos, page_tasks),
+                media_type="application/x-ndjson"
+            )
+        
+        try:
+            pages = await asyncio.gather(*page_tasks)
+        except Exception:
+            for task in page_tasks:
+                task.cancel()
+            raise
+        
+        all_repos = list(first_repos)
+        for repos in pages:
+            all_repos.extend(repos)
+        
+        repositories = [format_repository(repo) for repo in all_repos]
+        
+        return {"repositories": repositories, "total": len(repositories)}
+        
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="GitHub API timeout")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch repositories: {str(e)}")
+        
+@app.get("/api/repository/tree/{owner}/{repo}")
+async def get_repository_tree(
+    owner: str,
+    repo: str,
+    lazy: bool = False,
+    since: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get the repository tree - the whole tree, or only the top level when lazy.
+
+    With ``since`` (a tree SHA the client already has) only the changes from
+    that tree are returned, as ``changes`` with ``delta: true``.
+    """
+    github_token = current_user["github_token"]
+    try:
+        _, repo_data = await github_get_json(github_token, f"{GITHUB_API_URL}/repos/{owner}/{repo}")
+        if repo_data is None:
+            raise HTTPException(status_code=404, detail="Repository not found")
+        default_branch = repo_data.get("default_branch", "main")
+        tree = await get_compact_tree(github_token, owner, repo, default_branch, recursive=not lazy or bool(since))
+        grant_repo_access(current_user["id"], f"{owner}/{repo}")
+        
+        if since:
+            delta = await tree_delta(github_token, owner, repo, since, tree)
+            if delta is not None:
+                return {
+                    "owner": owner,
+                    "repo": repo,
+                    "default_branch": default_branch,
+                    "tree_sha": tree.sha,
+                    "base_tree_sha": since,
+                    "truncated": False,
+                    "delta": True,
+                    "changes": delta
+                }
+            # The base tree is unknown or too large to diff - send the tree itself
+        
+        schedule_prefetch(github_token, current_user["id"], owner, repo, tree, lazy)
+        file_tree = tree.level() if lazy else tree.to_nested()
+        return {
+            "owner": owner,
+            "repo": repo,
+            "default_branch": default_branch,
+            "tree_sha": tree.sha,
+            "truncated": tree.truncated,
+            "tree": file_tree
+        }
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="GitHub API timeout")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch repository tree: {str(e)}")
+
+async def tree_delta(github_token: str, owner: str, repo: str, base_sha: str, tree: CompactTree) -> Optional[List[Dict]]:
+    """Changes from ``base_sha`` to ``tree``, or None when a full tree must be sent instead"""
+    if base_sha == tree.sha:
+        return []
+    if tree.truncated:
+        return None
+    try:
+        # Trees are immutable, so the base is usually still in the ETag cache
+        base = await get_compact_tree(github_token, owner, repo, base_sha)
+    except HTTPException:
+        return None
+    if base.truncated:
+        return None
+    return tree.diff(base)
+
+@app.get("/api/repository/tree/{owner}/{repo}/children")
+async def get_repository_tree_children(
+    owner: str,
+    repo: str,
+    sha: str,
+    path: str = "",
+    current_user: dict = Depends(get_current_user)
+):
+    """Get one directory level of the repository tree by its tree SHA"""
+    github_token = current_user["github_token"]
+    try:
+        tree = await get_compact_tree(github_token, owner, repo, sha, recursive=False)
+        return {"owner": owner, "repo": repo, "path": path, "tree_sha": tree.sha, "tree": tree.level(path.strip("/"))}
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="GitHub API timeout")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch repository tree: {str(e)}")
+
+@app.get("/api/repository/search/{owner}/{repo}")
+async def search_repository(
+    owner: str,
+    repo: str,
+    q: str,
+    regex: bool = False,
+    case_sensitive: bool = False,
+    limit: int = 50,
+    current_user: dict = Depends(get_current_user)
+):
+    """Search file contents on the default branch using the repository's trigram index"""
+    if not q or len(q) > 256:
+        raise HTTPException(status_code=400, detail="Query must be between 1 and 256 characters")
+    if regex:
+        try:
+            re.compile(q)
+        except re.error as e:
+            raise HTTPException(status_code=400, detail=f"Invalid regular expression: {str(e)}")
+    
+    github_token = current_user["github_token"]
+    started = time.perf_counter()
+    try:
+        index = await ensure_search_index(github_token, owner, repo)
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="GitHub API timeout")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to build search index: {str(e)}")
+    
+    grant_repo_access(current_user["id"], f"{owner}/{repo}")
+    results = await run_search(index, q, regex, case_sensitive, max(1, min(limit, 200)))
+    return {
+        "query": q,
+        "results": results,
+        "total": len(results),
+        "indexedFiles": len(index.doc_ids),
+        # Files still being fetched in the background are not searched yet
+        "partial": bool(index.pending),
+        "pendingFiles": len(index.pending),
+        "tookMs": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+def raw_file_url(owner: str, repo: str, path: str, sha: Optional[str]) -> str:
+    url = f"/api/repository/raw/{owner}/{repo}?path={quote(path)}"
+    return url + (f"&sha={sha}" if sha else "")
+
+def large_file_response(path: str, name: str, sha: Optional[str], size: int, owner: str, repo: str) -> Dict[str, Any]:
+    """Metadata for a file too large to inline; the client pages through ``rawUrl`` instead"""
+    return {
+        "path": path,
+        "name": name,
+        "content": "",
+        "sha": sha,
+        "size": size,
+        "truncated": True,
+        "rawUrl": raw_file_url(owner, repo, path, sha)
+    }
+
+def blob_file_response(path: str, sha: str, data: bytes, owner: str, repo: str) -> Dict[str, Any]:
+    name = path.rsplit("/", 1)[-1]
+    if len(data) > FILE_INLINE_MAX_BYTES:
+        return large_file_response(path, name, sha, len(data), owner, repo)
+    return {
+        "path": path,
+        "name": name,
+        "content": decode_blob_text(data),
+        "sha": sha,
+        "size": len(data)
+    }
+
+async def cached_file(user_id: int, owner: str, repo: str, path: str, sha: Optional[str]) -> Optional[Dict[str, Any]]:
+    """The file from the blob cache, when the client already knows its SHA"""
+    repo_key = f"{owner}/{repo}"
+    if not sha or not has_repo_access(user_id, repo_key):
+        return None
+    data = await blob_cache.get(sha, repo_key)
+    if data is None:
+        return None
+    remember_opened_file(user_id, repo_key, path, sha)
+    return blob_file_response(path, sha, data, owner, repo)
+
+async def fetch_file(github_token: str, user_id: int, owner: str, repo: str, path: str) -> Dict[str, Any]:
+    """Read a file through the Contents API and keep its bytes in the blob cache"""
+    repo_key = f"{owner}/{repo}"
+    _, file_data = await github_get_json(
+        github_token,
+        f"{GITHUB_API_URL}/repos/{owner}/{repo}/contents/{path}"
+    )
+        
+    if file_data is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    # Past 1 MB the Contents API leaves "content" empty (encoding "none")
+    if file_data.get("encoding") == "none" or file_data.get("size", 0) > FILE_INLINE_MAX_BYTES:
+        grant_repo_access(user_id, repo_key)
+        remember_opened_file(user_id, repo_key, file_data["path"], file_data["sha"])
+        return large_file_response(file_data["path"], file_data["name"], file_data["sha"], file_data["size"], owner, repo)
+        
+    raw = base64.b64decode(file_data.get("content") or "")
+    grant_repo_access(user_id, repo_key)
+    await blob_cache.put(file_data["sha"], raw, repo_key)
+    remember_opened_file(user_id, repo_key, file_data["path"], file_data["sha"])
+    content = decode_blob_text(raw)
+        
+    return {
+        "path": file_data["path"],
+        "name": file_data["name"],
+        "content": content,
+        "sha": file_data["sha"],
+        "size": file_data["size"]
+    }
+
+@app.get("/api/repository/file/{owner}/{repo}")
+async def get_file_content(
+    owner: str,
+    repo: str,
+    path: str,
+    sha: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get file content from repository"""
+    # The tree already told the client the blob SHA - serve it without calling GitHub
+    cached = await cached_file(current_user["id"], owner, repo, path, sha)
+    if cached is not None:
+        return cached
+    
+    try:
+        return await fetch_file(current_user["github_token"], current_user["id"], owner, repo, path)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch file: {str(e)}")
+
+@app.post("/api/repository/files/{owner}/{repo}")
+async def get_files(
+    owner: str,
+    repo: str,
+    request: BatchFilesRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Fetch several files at once, streamed back as NDJSON in the order they complete.
+
+    Each entry names a ``path`` (optionally with its blob ``sha``) or just a
+    ``sha``. Cached blobs are answered straight away; the rest are fetched
+    from GitHub at most ``BATCH_FETCH_CONCURRENCY`` at a time. Every entry
+    yields one line carrying its ``index`` in the request and either the file
+    or an ``error``; a final ``{"done": true}`` line carries the counts.
+    """
+    if not request.files:
+        raise HTTPException(status_code=400, detail="No files requested")
+    if len(request.files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_FILES} files per request")
+    
+    github_token = current_user["github_token"]
+    user_id = current_user["id"]
+    semaphore = asyncio.Semaphore(BATCH_FETCH_CONCURRENCY)
+    
+    async def load(index: int, item: Dict[str, Any]) -> Dict[str, Any]:
+        path, sha = item.get("path"), item.get("sha")
+        try:
+            if not path and not sha:
+                raise HTTPException(status_code=400, detail="Each file needs a path or a sha")
+            result = await cached_file(user_id, owner, repo, path or "", sha)
+            if result is None:
+                async with semaphore:
+                    if path:
+                        result = await fetch_file(github_token, user_id, owner, repo, path)
+                    else:
+                        # Without recorded access the cache may not answer - GitHub has to check the user's token
+                        data = await fetch_blob(github_token, owner, repo, sha)
+                        grant_repo_access(user_id, f"{owner}/{repo}")
+                        result = blob_file_response("", sha, data, owner, repo)
+            return dict(result, index=index)
+        except HTTPException as e:
+            return {"index": index, "path": path, "sha": sha, "error": e.detail, "status": e.status_code}
+        except Exception as e:
+            return {"index": index, "path": path, "sha": sha, "error": str(e), "status": 500}
+    
+    tasks = [asyncio.ensure_future(load(index, item)) for index, item in enumerate(request.files)]
+    
+    async def results():
+        failed = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                failed += "error" in result
+                yield json.dumps(result) + "\n"
+            yield json.dumps({"done": True, "total": len(tasks), "failed": failed}) + "\n"
+        finally:
+            # A client that went away leaves nothing running behind it
+            for task in tasks:
+                task.cancel()
+    
+    return StreamingResponse(results(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache"})
+
+def parse_byte_range(header: Optional[str], total: Optional[int]) -> Optional[tuple]:
+    """Parse a single ``bytes=`` range into inclusive ``(start, end)``.
+
+    Returns None when the whole body should be sent - no header, a form we
+    do not serve (multiple ranges), or a suffix range while the length is
+    unknown.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if not first:
+            if total is None:
+                return None
+            suffix = int(last)
+            if suffix <= 0:
+                raise ValueError
+            return max(total - suffix, 0), total - 1
+        start = int(first)
+        end = int(last) if last else None
+    except ValueError:
+        raise HTTPException(status_code=416, detail="Invalid Range header")
+    if total is not None:
+        end = total - 1 if end is None else min(end, total - 1)
+    elif end is None:
+        # An open range needs the length for its Content-Range
+        return None
+    if (end is not None and end < start) or (total is not None and start >= total):
+        raise HTTPException(
+            status_code=416,
+            detail="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{total if total is not None else '*'}"}
+        )
+    return start, end
+
+def is_binary_prefix(prefix: bytes) -> bool:
+    """NUL bytes or invalid UTF-8 in the first bytes mark a file as binary"""
+    if b"\0" in prefix:
+        return True
+    # A range can start inside a multi-byte character
+    for _ in range(3):
+        if prefix[:1] and 0x80 <= prefix[0] <= 0xBF:
+            prefix = prefix[1:]
+    try:
+        # Incremental, so a character cut off at the end of the prefix is not an error
+        codecs.getincrementaldecoder("utf-8")().decode(prefix, final=False)
+        return False
+    except UnicodeDecodeError:
+        return True
+
+async def trim_to_range(chunks, start: int, end: int):
+    """Pass through only bytes ``start``..``end`` (inclusive) of a chunk stream"""
+    position = 0
+    async for chunk in chunks:
+        chunk_end = position + len(chunk)
+        if chunk_end > start:
+            yield chunk[max(start - position, 0):end + 1 - position]
+        position = chunk_end
+        if position > end:
+            break
+
+async def memory_chunks(data: bytes):
+    view = memoryview(data)
+    for offset in range(0, len(view), RAW_CHUNK_BYTES):
+        yield bytes(view[offset:offset + RAW_CHUNK_BYTES])
+
+async def sniff_stream(chunks):
+    """Read just enough of ``chunks`` to sniff; returns ``(is_binary, body)`` where body replays it all"""
+    iterator = chunks.__aiter__()
+    head = []
+    size = 0
+    async for chunk in iterator:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= RAW_SNIFF_BYTES:
+            break
+    
+    async def body():
+        for chunk in head:
+            yield chunk
+        async for chunk in iterator:
+            yield chunk
+    
+    return is_binary_prefix(b"".join(head)[:RAW_SNIFF_BYTES]), body()
+
+@app.get("/api/repository/raw/{owner}/{repo}")
+async def get_raw_file(
+    owner: str,
+    repo: str,
+    path: str,
+    request: Request,
+    sha: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream a file's raw bytes, honouring a single HTTP Range.
+
+    Cached blobs are served from memory; otherwise the bytes are relayed from
+    GitHub's raw media type chunk by chunk, so memory stays flat whatever the
+    file size.
+    """
+    github_token = current_user["github_token"]
+    repo_key = f"{owner}/{repo}"
+    range_header = request.headers.get("range")
+    headers = {"Accept-Ranges": "bytes"}
+    upstream = None
+    
+    data = await blob_cache.get(sha, repo_key) if sha and has_repo_access(current_user["id"], repo_key) else None
+    if data is not None:
+        total = len(data)
+        byte_range = parse_byte_range(range_header, total)
+        chunks = memory_chunks(data if byte_range is None else data[byte_range[0]:byte_range[1] + 1])
+    else:
+        url = (
+            f"{GITHUB_API_URL}/repos/{owner}/{repo}/git/blobs/{sha}" if sha
+            else f"{GITHUB_API_URL}/repos/{owner}/{repo}/contents/{path}"
+        )
+        upstream_headers = dict(github_headers(github_token), Accept="application/vnd.github.raw+json")
+        # Lengths and ranges are relayed as-is, so they must describe the bytes actually sent
+        upstream_headers["Accept-Encoding"] = "identity"
+        if range_header:
+            upstream_headers["Range"] = range_header
+        client = get_github_client()
+        upstream = await client.send(client.build_request("GET", url, headers=upstream_headers), stream=True)
+        if upstream.status_code not in (200, 206):
+            detail = (await upstream.aread()).decode("utf-8", errors="replace")[:500]
+            await upstream.aclose()
+            status_code = upstream.status_code if upstream.status_code in (401, 403, 404, 416) else 502
+            raise HTTPException(status_code=status_code, detail=f"GitHub API error: {detail}")
+        grant_repo_access(current_user["id"], repo_key)
+        
+        length = upstream.headers.get("content-length")
+        encoded = upstream.headers.get("content-encoding", "identity").lower() != "identity"
+        if encoded and upstream.status_code == 206:
+            # A range of compressed bytes cannot be decoded on its own
+            await upstream.aclose()
+            raise HTTPException(status_code=502, detail="GitHub returned a compressed partial response")
+        if encoded:
+            # aiter_bytes() decodes, so upstream lengths do not apply - send the whole file unsized
+            byte_range = None
+            total = None
+            chunks = upstream.aiter_bytes(RAW_CHUNK_BYTES)
+        elif upstream.status_code == 206:
+            # GitHub applied the range itself
+            byte_range = None
+            total = None
+            headers["Content-Range"] = upstream.headers.get("content-range", "")
+            if length is not None:
+                headers["Content-Length"] = length
+            chunks = upstream.aiter_bytes(RAW_CHUNK_BYTES)
+        else:
+            total = int(length) if length is not None else None
+            try:
+                byte_range = parse_byte_range(range_header, total)
+            except HTTPException:
+                await upstream.aclose()
+                raise
+            chunks = upstream.aiter_bytes(RAW_CHUNK_BYTES)
+            if byte_range is not None:
+                chunks = trim_to_range(chunks, *byte_range)
+    
+    status_code = 206 if "Content-Range" in headers else 200
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{total if total is not None else '*'}"
+        headers["Content-Length"] = str(end - start + 1)
+    elif total is not None:
+        headers["Content-Length"] = str(total)
+    
+    try:
+        binary, body = await sniff_stream(chunks)
+    except BaseException:
+        if upstream is not None:
+            await upstream.aclose()
+        raise
+    
+    async def relay():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            if upstream is not None:
+                await upstream.aclose()
+    
+    headers["X-Content-Binary"] = "true" if binary else "false"
+    return StreamingResponse(
+        relay(),
+        status_code=status_code,
+        media_type="application/octet-stream" if binary else "text/plain",
+        headers=headers
+    )
+
+@app.put("/api/repository/file/update")
+async def update_file(
+    request: UpdateFileRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Update file content in repository, from full content or a diff/edits against ``sha``"""
+    github_token = current_user["github_token"]
+    
+    client = get_github_client()
+    try:
+        data = await resolve_new_content(github_token, request.owner, request.repo, {
+            "content": request.content,
+            "diff": request.diff,
+            "edits": request.edits,
+            "sha": request.sha
+        })
+        encoded_content = base64.b64encode(data).decode("utf-8")
+        del data
+            
+        response = await client.put(
+            f"{GITHUB_API_URL}/repos/{request.owner}/{request.repo}/contents/{request.path}",
+            headers=github_headers(github_token),
+            json={
+                "message": request.message,
+                "content": encoded_content,
+                "sha": request.sha,
+                "branch": request.branch
+            }
+        )
+            
+        if response.status_code == 409:
+            raise HTTPException(status_code=409, detail="File has changed on the branch since it was loaded")
+        if response.status_code not in [200, 201]:
+            raise HTTPException(status_code=400, detail=f"Failed to update file: {response.text}")
+            
+        await forget_branch_changes(request.owner, request.repo, request.branch, [request.path])
+        result = response.json()
+            
+        return {
+            "message": "File updated successfully",
+            "sha": result["content"]["sha"],
+            "commit": result["commit"]["sha"]
+        }
+            
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to update file: {str(e)}")
+
+@app.post("/api/repository/file/create")
+async def create_file(
+    request: CreateFileRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Create new file in repository"""
+    github_token = current_user["github_token"]
+    
+    client = get_github_client()
+    try:
+        encoded_content = base64.b64encode(request.content.encode("utf-8")).decode("utf-8")
+            
+        response = await client.put(
+            f"{GITHUB_API_URL}/repos/{request.owner}/{request.repo}/contents/{request.path}",
+            headers=github_headers(github_token),
+            json={
+                "message": request.message,
+                "content": encoded_content,
+                "branch": request.branch
+            }
+        )
+            
+        if response.status_code not in [200, 201]:
+            raise HTTPException(status_code=400, detail=f"Failed to create file: {response.text}")
+            
+        await forget_branch_changes(request.owner, request.repo, request.branch, [request.path])
+        result = response.json()
+            
+        return {
+            "message": "File created successfully",
+            "sha": result["content"]["sha"],
+            "commit": result["commit"]["sha"],
+            "path": result["content"]["path"]
+        }
+            
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create file: {str(e)}")
+
+@app.delete("/api/repository/file/delete")
+async def delete_file(
+    request: DeleteFileRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Delete file from repository"""
+    github_token = current_user["github_token"]
+    
+    client = get_github_client()
+    try:
+        response = await client.delete(
+            f"{GITHUB_API_URL}/repos/{request.owner}/{request.repo}/contents/{request.path}",
+            headers=github_headers(github_token),
+            json={
+                "message": request.message,
+                "sha": request.sha,
+                "branch": request.branch
+            }
+        )
+            
+        if response.status_code not in [200, 204]:
+            raise HTTPException(status_code=400, detail=f"Failed to delete file: {response.text}")
+            
+        await forget_branch_changes(request.owner, request.repo, request.branch, [request.path])
+        return {
+            "message": "File deleted successfully",
+            "path": request.path
+        }
+            
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to delete file: {str(e)}")
+
+@app.put("/api/repository/file/rename")
+async def rename_file(
+    request: RenameFileRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Rename a file or move a folder in one commit, reusing the existing blob SHAs"""
+    github_token = current_user["github_token"]
+    old_path = request.oldPath.strip("/")
+    new_path = request.newPath.strip("/")
+    
+    try:
+        head = await get_branch_head(github_token, request.owner, request.repo, request.branch)
+        
+        # Walk down to both paths directory by directory - a recursive listing can be truncated
+        source = await resolve_tree_entry(github_token, request.owner, request.repo, head["tree"], old_path)
+        if source is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        if await resolve_tree_entry(github_token, request.owner, request.repo, head["tree"], new_path) is not None:
+            raise HTTPException(status_code=409, detail=f"{new_path} already exists")
+        
+        if source["kind"] == "tree":
+            # List the folder from its own tree so a truncated root listing cannot hide files
+            subtree = await get_compact_tree(github_token, request.owner, request.repo, source["sha"])
+            if subtree.truncated:
+                raise HTTPException(status_code=400, detail="Folder is too large to move in one commit")
+            moves = [
+                (f"{old_path}/{path}", f"{new_path}/{path}", mode, sha)
+                for path, kind, mode, sha in zip(subtree.paths, subtree.kinds, subtree.modes, subtree.shas)
+                if kind != "tree"
+            ]
+        else:
+            if request.sha and source["sha"] != request.sha:
+                raise HTTPException(status_code=409, detail="File has changed on the branch since it was loaded")
+            moves = [(old_path, new_path, source["mode"], source["sha"])]
+        
+        # Deleting the old path and adding the same blob SHA at the new one moves no content
+        tree_entries = []
+        for old_file, new_file, mode, sha in moves:
+            kind = "commit" if mode == "160000" else "blob"
+            tree_entries.append({"path": old_file, "mode": mode, "type": kind, "sha": None})
+            tree_entries.append({"path": new_file, "mode": mode, "type": kind, "sha": sha})
+        
+        commit = await commit_tree_changes(
+            github_token, request.owner, request.repo, request.branch,
+            head, tree_entries, request.message
+        )
+        
+        return {
+            "message": "File renamed successfully",
+            "oldPath": request.oldPath,
+            "newPath": request.newPath,
+            "sha": source["sha"],
+            "commit": commit["commit"],
+            "movedFiles": len(moves)
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to rename file: {str(e)}")
+
+@app.post("/api/repository/push")
+async def push_changes(
+    request: PushChangesRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Push multiple file changes to repository as a single commit.
+
+    Each change carries ``content``, or a ``diff`` or ``edits`` against its base ``sha``.
+    """
+    github_token = current_user["github_token"]
+    repo_key = f"{request.owner}/{request.repo}"
+    
+    if not request.changes:
+        return {"message": "Push completed", "results": [], "totalFiles": 0, "successCount": 0}
+    
+    try:
+        head = await get_branch_head(github_token, request.owner, request.repo, request.branch)
+        current_tree = await get_compact_tree(github_token, request.owner, request.repo, head["tree"])
+        
+        async def current_entry(path: str) -> Optional[Dict[str, str]]:
+            index = current_tree.index.get(path)
+            if index is not None:
+                return {"kind": current_tree.kinds[index], "mode": current_tree.modes[index], "sha": current_tree.shas[index]}
+            if current_tree.truncated:
+                # Missing from a truncated listing proves nothing - look the path up directly
+                return await resolve_tree_entry(github_token, request.owner, request.repo, head["tree"], path)
+            return None
+        
+        current_entries = await asyncio.gather(*(current_entry(change["path"]) for change in request.changes))
+        
+        errors: Dict[str, str] = {}
+        for change, entry in zip(request.changes, current_entries):
+            if entry is not None and change.get("sha") and entry["sha"] != change["sha"]:
+                errors[change["path"]] = "File has changed on the branch since it was loaded"
+        
+        semaphore = asyncio.Semaphore(GITHUB_WRITE_CONCURRENCY)
+        
+        async def upload(change: Dict[str, Any]) -> Optional[str]:
+            async with semaphore:
+                try:
+                    data = await resolve_new_content(github_token, request.owner, request.repo, change)
+                    blob_sha = await create_blob(github_token, request.owner, request.repo, data)
+                except Exception as e:
+                    errors[change["path"]] = str(getattr(e, "detail", e))
+                    return None
+            await blob_cache.put(blob_sha, data, repo_key)
+            return blob_sha
+        
+        blob_shas = []
+        if not errors:
+            blob_shas = await asyncio.gather(*(upload(change) for change in request.changes))
+        
+        # Nothing is committed unless every file made it - the push is all or nothing
+        if errors:
+            results = [{
+                "path": change["path"],
+                "status": "failed",
+                "error": errors.get(change["path"], "Not pushed because another file in this push failed")
+            } for change in request.changes]
+            return {
+                "message": "Push failed",
+                "results": results,
+                "totalFiles": len(request.changes),
+                "successCount": 0
+            }
+        
+        tree_entries = []
+        for change, entry, blob_sha in zip(request.changes, current_entries, blob_shas):
+            tree_entries.append({
+                "path": change["path"],
+                "mode": entry["mode"] if entry is not None else "100644",
+                "type": "blob",
+                "sha": blob_sha
+            })
+        commit = await commit_tree_changes(
+            github_token, request.owner, request.repo, request.branch,
+            head, tree_entries, request.commitMessage
+        )
+        
+        results = [{
+            "path": change["path"],
+            "status": "success",
+            "sha": blob_sha
+        } for change, blob_sha in zip(request.changes, blob_shas)]
+        
+        return {
+            "message": "Push completed",
+            "results": results,
+            "totalFiles": len(request.changes),
+            "successCount": len(results),
+            "commit": commit["commit"]
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to push changes: {str(e)}")
+
+# ==================== WEBHOOKS ====================
+
+# Past this many commits a push payload is cut short, so its file lists cannot be trusted
+PUSH_PAYLOAD_MAX_COMMITS = 2048
+# Repository actions after which cached copies may belong to someone who lost access
+ACCESS_CHANGING_ACTIONS = {"deleted", "transferred", "privatized", "renamed", "removed"}
+
+def verify_webhook_signature(secret: str, body: bytes, signature: Optional[str]) -> bool:
+    """Check an X-Hub-Signature-256 header against the raw payload"""
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature[len("sha256="):], expected)
+
+def parse_webhook_event(event_name: str, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Reduce a webhook payload to what cache invalidation needs.
+
+    Returns None for events that cannot affect anything cached. A push
+    carries ``paths`` only when its commit list is complete; otherwise every
+    entry for the branch is dropped.
+    """
+    repository = payload.get("repository") or {}
+    if not repository.get("full_name"):
+        return None
+    if event_name == "push":
+        ref = payload.get("ref") or ""
+        if not ref.startswith("refs/heads/"):
+            return None
+        branch = ref[len("refs/heads/"):]
+        commits = payload.get("commits") or []
+        paths = None
+        if commits and len(commits) < PUSH_PAYLOAD_MAX_COMMITS and not (payload.get("forced") or payload.get("deleted")):
+            paths = sorted({
+                path
+                for commit in commits
+                for field in ("added", "modified", "removed")
+                for path in commit.get(field) or []
+            })
+        return {
+            "type": "push",
+            "branch": branch,
+            "default": branch == repository.get("default_branch"),
+            "paths": paths,
+            "after": payload.get("after")
+        }
+    if event_name == "delete":
+        if payload.get("ref_type") != "branch":
+            return None
+        return {"type": "push", "branch": payload.get("ref"), "default": False, "paths": None}
+    if event_name in ("repository", "member", "meta"):
+        return {"type": event_name, "action": payload.get("action")}
+    if event_name == "ping":
+        return {"type": "ping"}
+    return None
+
+def branch_entry_matcher(event: Dict[str, Any]):
+    """Match cached URLs that read ``event``'s branch: its tree and the changed paths"""
+    branch = event["branch"]
+    paths = event.get("paths")
+    affected = None
+    if paths is not None:
+        # A directory listing changes along with any file below it
+        affected = {""}
+        for path in paths:
+            parts = path.split("/")
+            affected.update("/".join(parts[:i]) for i in range(1, len(parts) + 1))
+
+    def matches(url: httpx.URL) -> bool:
+        rest = url.path.strip("/").split("/")[3:]
+        if rest[:2] == ["git", "trees"]:
+            return "/".join(rest[2:]) == branch
+        if rest[:1] == ["branches"]:
+            return True
+        if rest[:1] == ["contents"]:
+            ref = url.params.get("ref")
+            if ref != branch and not (ref is None and event.get("default")):
+                return False
+            return affected is None or "/".join(rest[1:]).strip("/") in affected
+        return False
+
+    return matches
+
+def apply_repo_event(repo_key: str, event: Dict[str, Any]) -> int:
+    """Drop what ``event`` made stale in this process and return the number of cache entries dropped"""
+    kind = event["type"]
+    if kind == "push":
+        return github_cache.invalidate(repo_key, branch_entry_matcher(event))
+    if kind in ("repository", "member"):
+        if kind == "member" and event.get("action") != "removed":
+            return 0
+        if event.get("action") in ACCESS_CHANGING_ACTIONS:
+            for key in [key for key in search_indexes.indexes if key.lower() == repo_key]:
+                search_indexes.drop(key)
+            for repos in repo_access.values():
+                repos.difference_update([key for key in repos if key.lower() == repo_key])
+        return github_cache.invalidate(repo_key)
+    return 0
+
+class RepoEventLog:
+    """This process's copy of the webhook events in the session store.
+
+    Events are applied to local caches as they are pulled, at most every
+    ``sync_seconds``. A repository counts as covered - its cached reads may
+    skip revalidation - while it has delivered a webhook within
+    ``coverage_seconds`` and the hook has not been deleted since.
+    """
+
+    def __init__(self, store: SessionStore, sync_seconds: float, coverage_seconds: float):
+        self.store = store
+        self.sync_seconds = sync_seconds
+        self.coverage_seconds = coverage_seconds
+        self.covered: Dict[str, float] = {}
+        self.own: set = set()
+        self.cursor = 0
+        self.next_sync = 0.0
+        self.applied = 0
+
+    def sync(self):
+        for cursor, repo_key, event, received_at in self.store.repo_events_since(self.cursor):
+            self.cursor = cursor
+            if cursor in self.own:
+                self.own.discard(cursor)
+                continue
+            self.apply(repo_key, event, received_at)
+        self.next_sync = time.monotonic() + self.sync_seconds
+
+    def apply(self, repo_key: str, event: Dict[str, Any], received_at: float) -> int:
+        if event["type"] == "meta":
+            if event.get("action") == "deleted":
+                self.covered.pop(repo_key, None)
+        elif not event.get("local"):
+            self.covered[repo_key] = max(self.covered.get(repo_key, 0.0), received_at)
+        self.applied += 1
+        return apply_repo_event(repo_key, event)
+
+    async def record(self, repo_key: str, event: Dict[str, Any]) -> int:
+        """Apply an event here at once and share it with the other workers"""
+        cursor = await asyncio.to_thread(self.store.record_repo_event, repo_key, event, self.coverage_seconds)
+        # A sync while the write was in flight may already have pulled it; applying twice is harmless
+        if cursor > self.cursor:
+            self.own.add(cursor)
+        return self.apply(repo_key, event, time.time())
+
+    def covers(self, repo_key: str) -> bool:
+        if time.monotonic() >= self.next_sync:
+            self.sync()
+        received_at = self.covered.get(repo_key)
+        return received_at is not None and time.time() - received_at < self.coverage_seconds
+
+    def stats(self) -> Dict[str, Any]:
+        return {"covered_repos": len(self.covered), "applied": self.applied, "cursor": self.cursor}
+
+repo_events = RepoEventLog(session_store, WEBHOOK_SYNC_SECONDS, WEBHOOK_COVERAGE_SECONDS)
+
+async def forget_branch_changes(owner: str, repo: str, branch: str, paths: List[str]):
+    """Invalidate what a write through this server changed, without waiting for its webhook"""
+    event = {"type": "push", "branch": branch, "default": True, "paths": sorted(set(paths)), "local": True}
+    await repo_events.record(f"{owner}/{repo}".lower(), event)
+
+@app.post("/webhooks/github")
+async def github_webhook(request: Request):
+    """Receive GitHub push, delete and repository events and invalidate the affected cache entries"""
+    if not GITHUB_WEBHOOK_SECRET:
+        raise HTTPException(status_code=404, detail="Webhooks are not configured")
+    body = await request.body()
+    if not verify_webhook_signature(GITHUB_WEBHOOK_SECRET, body, request.headers.get("X-Hub-Signature-256")):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    
+    event_name = request.headers.get("X-GitHub-Event", "")
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            payload = json.loads(parse_qs(body.decode("utf-8")).get("payload", ["{}"])[0])
+        else:
+            payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid webhook payload")
+    
+    event = parse_webhook_event(event_name, payload) if isinstance(payload, dict) else None
+    if event is None:
+        return {"status": "ignored", "event": event_name}
+    
+    repo_key = payload["repository"]["full_name"].lower()
+    invalidated = await repo_events.record(repo_key, event)
+    logger.info("Webhook applied", extra={
+        "event": event_name,
+        "delivery": request.headers.get("X-GitHub-Delivery"),
+        "repo": repo_key,
+        "invalidated": invalidated
+    })
+    return {"status": "ok", "event": event_name, "invalidated": invalidated}
+
+# ==================== AI CLIENT ====================
+
+ai_client: Optional[httpx.AsyncClient] = None
+
+def get_ai_client() -> httpx.AsyncClient:
+    """Return the shared model-router client, creating it on first use"""
+    global ai_client
+    if ai_client is None or ai_client.is_closed:
+        ai_client = httpx.AsyncClient(timeout=httpx.Timeout(AI_TIMEOUT, connect=GITHUB_CONNECT_TIMEOUT))
+    return ai_client
+
+async def close_ai_client():
+    global ai_client
+    if ai_client is not None:
+        await ai_client.aclose()
+        ai_client = None
+
+def ai_headers() -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {HF_TOKEN}",
+        "Content-Type": "application/json"
+    }
+
+def build_chat_messages(system_prompt: str, user_prompt: str, history: List[Dict]) -> List[Dict]:
+    """Build the chat-completion message list"""
+    messages = [
+        {"role": "system", "content": system_prompt}
+    ]
+    
+    # Add conversation history - newest first, into whatever budget the prompt left
+    messages.extend(pack_history(history, PROMPT_TOKEN_BUDGET - count_tokens(system_prompt) - count_tokens(user_prompt)))
+    
+    # Add current user prompt
+    messages.append({"role": "user", "content": user_prompt})
+    return messages
+
+def build_completion_payload(messages: List[Dict], stream: bool = False) -> Dict[str, Any]:
+    payload = {
+        "model": HF_MODEL,
+        "messages": messages,
+        "max_tokens": 2000,
+        "temperature": 0.7,
+        "top_p": 0.95,
+        "stream": stream
+    }
+    if stream:
+        # Ask for a final chunk carrying token usage
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+# ==================== CONTEXT PACKING ====================
+
+tokenizer = None
+
+def load_tokenizer():
+    """Load the model tokenizer from a local tokenizer.json or the Hugging Face Hub"""
+    global tokenizer
+    try:
+        from tokenizers import Tokenizer
+        if os.path.isfile(TOKENIZER_NAME):
+            tokenizer = Tokenizer.from_file(TOKENIZER_NAME)
+        else:
+            tokenizer = Tokenizer.from_pretrained(TOKENIZER_NAME, token=HF_TOKEN)
+        ai_logger.info("Loaded tokenizer", extra={"tokenizer": TOKENIZER_NAME})
+    except Exception as e:
+        ai_logger.warning("Tokenizer unavailable, estimating tokens from length", extra={"error": str(e)})
+
+def count_tokens(text: str) -> int:
+    """Count model tokens, estimating four characters per token until the tokenizer loads"""
+    if not text:
+        return 0
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    return (len(text) + 3) // 4
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    if tokenizer is not None:
+        encoding = tokenizer.encode(text, add_special_tokens=False)
+        if len(encoding.ids) <= max_tokens:
+            return text
+        return text[:encoding.offsets[max_tokens - 1][1]]
+    return text[:max_tokens * 4]
+
+# Per-line token counts of recently packed files, keyed by blob SHA and length
+blob_token_counts: "OrderedDict[tuple, array]" = OrderedDict()
+
+def file_line_tokens(lines: List[str], blob_sha: Optional[str], length: int) -> array:
+    key = (blob_sha, length)
+    if blob_sha and key in blob_token_counts:
+        blob_token_counts.move_to_end(key)
+        return blob_token_counts[key]
+    if tokenizer is not None:
+        counts = array("I", (len(e.ids) for e in tokenizer.encode_batch(lines, add_special_tokens=False)))
+    else:
+        counts = array("I", ((len(line) + 3) // 4 for line in lines))
+    if blob_sha:
+        blob_token_counts[key] = counts
+        while len(blob_token_counts) > BLOB_TOKEN_CACHE_ENTRIES:
+            blob_token_counts.popitem(last=False)
+    return counts
+
+def pack_file_excerpt(content: str, selection: str, budget: int, blob_sha: Optional[str] = None) -> tuple:
+    """Choose the lines of ``content`` that fit ``budget`` tokens.
+
+    The whole file is used when it fits. Otherwise the window starts at the
+    selection (or the top of the file) and grows one line below and one line
+    above at a time. Returns ``(excerpt, first_line, last_line, total_lines)``.
+    """
+    # Only "\n" ends a line, so line numbers agree with the selection offset below
+    lines = split_lines(content)
+    total = len(lines)
+    counts = file_line_tokens(lines, blob_sha, len(content))
+    if sum(counts) <= budget:
+        return content, 1, total, total
+    
+    start = end = 0
+    if selection:
+        offset = content.find(selection)
+        if offset >= 0:
+            start = content.count("\n", 0, offset)
+            end = start + selection.count("\n") + 1
+    
+    low = high = start
+    used = 0
+    while high < min(end, total) and used + counts[high] <= budget:
+        used += counts[high]
+        high += 1
+    while True:
+        grew = False
+        if high < total and used + counts[high] <= budget:
+            used += counts[high]
+            high += 1
+            grew = True
+        if low > 0 and used + counts[low - 1] <= budget:
+            low -= 1
+            used += counts[low]
+            grew = True
+        if not grew:
+            break
+    return "".join(lines[low:high]), low + 1, high, total
+
+def pack_history(history: List[Dict], budget: int) -> List[Dict]:
+    """Keep the newest history messages that fit ``budget`` tokens"""
+    packed = []
+    for msg in reversed(history):
+        if budget <= 0:
+            break
+        content = msg["content"]
+        cost = count_tokens(content) + 4  # role and message framing
+        if cost > budget:
+            content = truncate_to_tokens(content, budget - 4)
+            if not content:
+                break
+        packed.append({"role": msg["role"], "content": content})
+        budget -= cost
+    packed.reverse()
+    return packed
+
+# ==================== LLM RESPONSE CACHE ====================
+
+class LLMResponseCache:
+    """TTL + LRU cache of model answers keyed by a hash of everything sent to the model"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, text = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return text
+
+    def put(self, key: str, text: str):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, text)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+llm_cache = LLMResponseCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS)
+
+def normalize_prompt(text: str) -> str:
+    """Normalize line endings and trailing whitespace so trivially different prompts share a cache key.
+
+    Indentation and spacing inside lines are kept - prompts carry code, where they matter.
+    """
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+def llm_cache_key(system_prompt: str, user_prompt: str, history: List[Dict], request: AnalyzeRequest) -> str:
+    """Hash the prompts, the history actually sent, the file blob SHA and the model parameters"""
+    messages = build_chat_messages(system_prompt, user_prompt, history)
+    params = build_completion_payload([])
+    params.pop("messages")
+    params.pop("stream")
+    key_material = {
+        "messages": [{"role": m["role"], "content": normalize_prompt(m["content"])} for m in messages],
+        "blob_sha": (request.currentFile or {}).get("sha"),
+        "params": params
+    }
+    return hashlib.sha256(json.dumps(key_material, sort_keys=True).encode("utf-8")).hexdigest()
+
+def lookup_cached_response(cache_key: str, request: AnalyzeRequest) -> Optional[str]:
+    if request.noCache:
+        llm_cache.bypassed += 1
+        return None
+    return llm_cache.get(cache_key)
 
-@app.get("/api/repository/file/{owner}/{repo}")
-async def get_file_content(
-    owner: str,
-    repo: str,
-    path: str,
-    current_user: dict = Depends(get_current_user)
-):
-    """Get file content from repository"""
-    github_token = current_user["github_token"]
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.get(
-                f"https://api.github.com/repos/{owner}/{repo}/contents/{path}",
-                headers={
-                    "Authorization": f"token {github_token}",
-                    "Accept": "application/vnd.github.v3+json"
-                }
-            )
-            
-            if response.status_code != 200:
-                raise HTTPException(status_code=404, detail="File not found")
-            
-            file_data = response.json()
-            
+# ==================== LLM DISPATCHER ====================
+
+class LLMDispatcher:
+    """Admission control for model router calls.
+
+    At most ``capacity`` calls run upstream at once. Callers beyond that wait
+    in one queue per user, and freed slots are handed out round-robin across
+    users so a single user cannot take all the capacity. Identical concurrent
+    requests share a single upstream call.
+    """
+
+    def __init__(self, capacity: int, max_queue: int, queue_timeout: float):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.queues: "OrderedDict[str, deque]" = OrderedDict()
+        self.calls: Dict[str, asyncio.Task] = {}
+        self.call_waiters: Dict[asyncio.Task, int] = {}
+        self.dispatched = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self, user_id: str):
+        started = time.monotonic()
+        if self.in_flight < self.capacity and not self.waiting:
+            self.in_flight += 1
+        else:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise HTTPException(status_code=503, detail="AI request queue is full")
+            waiter = asyncio.get_running_loop().create_future()
+            self.queues.setdefault(user_id, deque()).append(waiter)
+            self.waiting += 1
             try:
-                content = base64.b64decode(file_data["content"]).decode("utf-8")
-            except:
-                content = "[Binary file - cannot display]"
-            
-            return {
-                "path": file_data["path"],
-                "name": file_data["name"],
-                "content": content,
-                "sha": file_data["sha"],
-                "size": file_data["size"]
-            }
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to fetch file: {str(e)}")
+                await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.abandon(user_id, waiter)
+                self.rejected += 1
+                raise HTTPException(status_code=503, detail="Timed out waiting for AI capacity")
+            except asyncio.CancelledError:
+                self.abandon(user_id, waiter)
+                raise
+        waited = time.monotonic() - started
+        self.dispatched += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
 
-@app.put("/api/repository/file/update")
-async def update_file(
-    request: UpdateFileRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Update file content in repository"""
-    github_token = current_user["github_token"]
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
+    def abandon(self, user_id: str, waiter: asyncio.Future):
+        if waiter.done() and not waiter.cancelled():
+            # The slot was handed over just as we gave up - pass it on
+            self.release()
+            return
+        waiter.cancel()
+        queue = self.queues.get(user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self.waiting -= 1
+            if not queue:
+                del self.queues[user_id]
+
+    def release(self):
+        # Hand the slot straight to the next user in turn instead of freeing it
+        while self.queues:
+            user_id, queue = next(iter(self.queues.items()))
+            waiter = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self.queues.move_to_end(user_id)
+            else:
+                del self.queues[user_id]
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: str):
+        await self.acquire(user_id)
         try:
-            encoded_content = base64.b64encode(request.content.encode("utf-8")).decode("utf-8")
-            
-            response = await client.put(
-                f"https://api.github.com/repos/{request.owner}/{request.repo}/contents/{request.path}",
-                headers={
-                    "Authorization": f"token {github_token}",
-                    "Accept": "application/vnd.github.v3+json"
-                },
-                json={
-                    "message": request.message,
-                    "content": encoded_content,
-                    "sha": request.sha,
-                    "branch": request.branch
-                }
-            )
-            
-            if response.status_code not in [200, 201]:
-                raise HTTPException(status_code=400, detail=f"Failed to update file: {response.text}")
-            
-            result = response.json()
-            
-            return {
-                "message": "File updated successfully",
-                "sha": result["content"]["sha"],
-                "commit": result["commit"]["sha"]
-            }
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to update file: {str(e)}")
+            yield
+        finally:
+            self.release()
 
-@app.post("/api/repository/file/create")
-async def create_file(
-    request: CreateFileRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Create new file in repository"""
-    github_token = current_user["github_token"]
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
+    async def run(self, key: Optional[str], user_id: str, call):
+        """Run ``call()`` under a slot, joining an identical call already in flight.
+
+        A cancelled caller gives up its queue place. A shared call is cancelled
+        once every caller waiting on it has gone.
+        """
+        async def guarded():
+            async with self.slot(user_id):
+                return await call()
+
+        if key is None:
+            return await guarded()
+
+        task = self.calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self.calls[key] = asyncio.ensure_future(guarded())
+
+            def finished(done):
+                if self.calls.get(key) is done:
+                    del self.calls[key]
+
+            task.add_done_callback(finished)
+        self.call_waiters[task] = self.call_waiters.get(task, 0) + 1
         try:
-            encoded_content = base64.b64encode(request.content.encode("utf-8")).decode("utf-8")
-            
-            response = await client.put(
-                f"https://api.github.com/repos/{request.owner}/{request.repo}/contents/{request.path}",
-                headers={
-                    "Authorization": f"token {github_token}",
-                    "Accept": "application/vnd.github.v3+json"
-                },
-                json={
-                    "message": request.message,
-                    "content": encoded_content,
-                    "branch": request.branch
-                }
-            )
-            
-            if response.status_code not in [200, 201]:
-                raise HTTPException(status_code=400, detail=f"Failed to create file: {response.text}")
-            
-            result = response.json()
-            
-            return {
-                "message": "File created successfully",
-                "sha": result["content"]["sha"],
-                "commit": result["commit"]["sha"],
-                "path": result["content"]["path"]
-            }
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to create file: {str(e)}")
+            return await asyncio.shield(task)
+        finally:
+            self.call_waiters[task] -= 1
+            if not self.call_waiters[task]:
+                del self.call_waiters[task]
+                if not task.done():
+                    task.cancel()
 
-@app.delete("/api/repository/file/delete")
-async def delete_file(
-    request: DeleteFileRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Delete file from repository"""
-    github_token = current_user["github_token"]
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "queued_users": len(self.queues),
+            "dispatched": self.dispatched,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / self.dispatched * 1000, 1) if self.dispatched else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1)
+        }
+
+llm_dispatcher = LLMDispatcher(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT)
+
+async def dispatch_stream(user_id: str, system_prompt: str, user_prompt: str, history: List[Dict]):
+    """Stream completion deltas while holding a dispatcher slot"""
+    if router_circuit.is_open():
+        raise CircuitOpenError()
+    async with llm_dispatcher.slot(user_id):
+        async for delta in stream_deepseek_api(system_prompt, user_prompt, history):
+            yield delta
+
+# ==================== ROUTER RESILIENCE ====================
+
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+class RouterError(Exception):
+    """The model router answered with a non-200 status"""
+
+    def __init__(self, status_code: int, text: str, retry_after: Optional[float] = None):
+        super().__init__(f"API returned status {status_code}: {text}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class CircuitOpenError(Exception):
+    def __init__(self):
+        super().__init__("Model router is unavailable (circuit open)")
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    After ``failure_threshold`` failures in a row the circuit opens and calls
+    fail immediately. Once ``reset_seconds`` have passed, a single probe call
+    is let through: success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.opens = 0
+        self.short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half_open"
+
+    def is_open(self) -> bool:
+        return self.state == "open" or (self.state == "half_open" and self.probing)
+
+    def before_call(self):
+        if self.is_open():
+            self.short_circuited += 1
+            raise CircuitOpenError()
+        if self.state == "half_open":
+            self.probing = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probing:
+                self.opens += 1
+                ai_logger.warning("Circuit opened", extra={"consecutive_failures": self.failures})
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def record_error(self, error: BaseException):
+        """Count router-side failures; an ordinary 4xx still proves the router is up"""
+        if is_retryable_router_error(error):
+            self.record_failure()
+        elif isinstance(error, RouterError):
+            self.record_success()
+        else:
+            # Cancelled or unrelated - no verdict, but let another probe through
+            self.probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opens": self.opens,
+            "short_circuited": self.short_circuited
+        }
+
+router_circuit = CircuitBreaker(AI_CIRCUIT_FAILURE_THRESHOLD, AI_CIRCUIT_RESET_SECONDS)
+
+def is_retryable_router_error(error: BaseException) -> bool:
+    if isinstance(error, RouterError):
+        return error.status_code in RETRYABLE_STATUSES
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After is either delay-seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def router_error(response: httpx.Response, text: str) -> RouterError:
+    return RouterError(response.status_code, text, parse_retry_after(response.headers.get("retry-after")))
+
+def next_retry_delay(error: BaseException, attempt: int, deadline: float) -> Optional[float]:
+    """Seconds to wait before retrying, or None when the error should be raised.
+
+    Backoff is exponential with full jitter; a Retry-After from the router
+    takes precedence. No retry is scheduled that would end past the deadline.
+    """
+    if attempt + 1 >= AI_RETRY_ATTEMPTS or not is_retryable_router_error(error) or router_circuit.is_open():
+        return None
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        delay = retry_after
+    else:
+        delay = random.uniform(0, min(AI_RETRY_MAX_DELAY, AI_RETRY_BASE_DELAY * 2 ** attempt))
+    if time.monotonic() + delay >= deadline:
+        return None
+    return delay
+
+async def call_router_with_retries(operation):
+    """Await ``operation(timeout)`` with retries, a shared deadline and the circuit breaker"""
+    deadline = time.monotonic() + AI_DEADLINE
+    attempt = 0
+    while True:
+        router_circuit.before_call()
+        remaining = deadline - time.monotonic()
         try:
-            response = await client.delete(
-                f"https://api.github.com/repos/{request.owner}/{request.repo}/contents/{request.path}",
-                headers={
-                    "Authorization": f"token {github_token}",
-                    "Accept": "application/vnd.github.v3+json"
-                },
-                json={
-                    "message": request.message,
-                    "sha": request.sha,
-                    "branch": request.branch
-                }
-            )
-            
-            if response.status_code not in [200, 204]:
-                raise HTTPException(status_code=400, detail=f"Failed to delete file: {response.text}")
-            
-            return {
-                "message": "File deleted successfully",
-                "path": request.path
-            }
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to delete file: {str(e)}")
+            result = await asyncio.wait_for(operation(min(AI_TIMEOUT, remaining)), remaining)
+        except BaseException as e:
+            router_circuit.record_error(e)
+            if not isinstance(e, Exception):
+                raise
+            delay = next_retry_delay(e, attempt, deadline)
+            if delay is None:
+                raise
+            ai_logger.info("Router call failed, retrying", extra={"attempt": attempt + 1, "error": str(e)[:200], "delay": round(delay, 3)})
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        router_circuit.record_success()
+        return result
 
-@app.put("/api/repository/file/rename")
-async def rename_file(
-    request: RenameFileRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Rename file in repository"""
-    github_token = current_user["github_token"]
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
+# ==================== CONVERSATION MEMORY ====================
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of a coding conversation between a user and an assistant. "
+    "Merge the new messages into the existing summary. Keep file names, decisions, requirements and "
+    "open questions; drop pleasantries and full code listings. Answer with the summary only, "
+    f"in at most {CHAT_SUMMARY_MAX_TOKENS} tokens."
+)
+
+summary_tasks: Dict[str, asyncio.Task] = {}
+summary_rerun: set = set()
+summary_stats = {"folded": 0, "fallback": 0, "stale": 0, "failed": 0}
+
+def transcript_line(message: Dict) -> str:
+    speaker = "User" if message.get("role") == "user" else "Assistant"
+    return f"{speaker}: {message.get('content', '')}"
+
+def extractive_summary(summary: str, messages: List[Dict]) -> str:
+    """Summary without the model: the opening line of each message, newest kept when over budget"""
+    lines = [line for line in summary.splitlines() if line.strip()]
+    for message in messages:
+        first = next((line.strip() for line in message.get("content", "").splitlines() if line.strip()), "")
+        if first:
+            lines.append(transcript_line({"role": message.get("role"), "content": first[:200]}))
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > CHAT_SUMMARY_MAX_TOKENS:
+        lines.pop(0)
+    return truncate_to_tokens("\n".join(lines), CHAT_SUMMARY_MAX_TOKENS)
+
+async def summarize_messages(user_id: str, summary: str, messages: List[Dict]) -> str:
+    """Fold ``messages`` into ``summary`` with the model, or extractively when it is unavailable"""
+    if HF_TOKEN and not router_circuit.is_open():
+        transcript = "\n\n".join(transcript_line(message) for message in messages)
+        prompt = f"Existing summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"
         try:
-            # First, get the old file content
-            get_response = await client.get(
-                f"https://api.github.com/repos/{request.owner}/{request.repo}/contents/{request.oldPath}",
-                headers={
-                    "Authorization": f"token {github_token}",
-                    "Accept": "application/vnd.github.v3+json"
-                }
-            )
-            
-            if get_response.status_code != 200:
-                raise HTTPException(status_code=404, detail="File not found")
-            
-            file_data = get_response.json()
-            content = file_data["content"]
-            
-            # Create file with new name
-            create_response = await client.put(
-                f"https://api.github.com/repos/{request.owner}/{request.repo}/contents/{request.newPath}",
-                headers={
-                    "Authorization": f"token {github_token}",
-                    "Accept": "application/vnd.github.v3+json"
-                },
-                json={
-                    "message": request.message,
-                    "content": content,
-                    "branch": request.branch
-                }
+            result = await llm_dispatcher.run(
+                None, user_id, lambda: call_deepseek_api(SUMMARY_SYSTEM_PROMPT, prompt, [])
             )
-            
-            if create_response.status_code not in [200, 201]:
-                raise HTTPException(status_code=400, detail=f"Failed to create renamed file: {create_response.text}")
-            
-            # Delete old file
-            delete_response = await client.delete(
-                f"https://api.github.com/repos/{request.owner}/{request.repo}/contents/{request.oldPath}",
-                headers={
-                    "Authorization": f"token {github_token}",
-                    "Accept": "application/vnd.github.v3+json"
-                },
-                json={
-                    "message": request.message,
-                    "sha": request.sha,
-                    "branch": request.branch
-                }
-            )
-            
-            if delete_response.status_code not in [200, 204]:
-                raise HTTPException(status_code=400, detail=f"Failed to delete old file: {delete_response.text}")
-            
-            result = create_response.json()
-            
-            return {
-                "message": "File renamed successfully",
-                "oldPath": request.oldPath,
-                "newPath": request.newPath,
-                "sha": result["content"]["sha"]
-            }
-            
+            return truncate_to_tokens(result, CHAT_SUMMARY_MAX_TOKENS)
         except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to rename file: {str(e)}")
+            chat_logger.info("Summary call failed, summarizing extractively", extra={"user_id": user_id, "error": str(e)})
+    summary_stats["fallback"] += 1
+    return extractive_summary(summary, messages)
 
-@app.post("/api/repository/push")
-async def push_changes(
-    request: PushChangesRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """Push multiple file changes to repository"""
-    github_token = current_user["github_token"]
-    
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            results = []
-            
-            for change in request.changes:
-                encoded_content = base64.b64encode(change["content"].encode("utf-8")).decode("utf-8")
-                
-                response = await client.put(
-                    f"https://api.github.com/repos/{request.owner}/{request.repo}/contents/{change['path']}",
-                    headers={
-                        "Authorization": f"token {github_token}",
-                        "Accept": "application/vnd.github.v3+json"
-                    },
-                    json={
-                        "message": request.commitMessage,
-                        "content": encoded_content,
-                        "sha": change["sha"],
-                        "branch": request.branch
-                    }
+async def run_summary(user_id: str):
+    """Fold evicted messages into the user's summary until none are pending"""
+    try:
+        while True:
+            summary_rerun.discard(user_id)
+            memory = session_store.get_chat_memory(user_id)
+            if memory and memory["pending"]:
+                pending = memory["pending"]
+                summary = await summarize_messages(
+                    user_id, memory["summary"], [item["message"] for item in pending]
                 )
-                
-                if response.status_code in [200, 201]:
-                    result = response.json()
-                    results.append({
-                        "path": change["path"],
-                        "status": "success",
-                        "sha": result["content"]["sha"]
-                    })
+                applied = await asyncio.to_thread(
+                    session_store.fold_chat_summary, user_id, summary, memory["summarized_seq"], pending[-1]["seq"]
+                )
+                if applied:
+                    summary_stats["folded"] += len(pending)
                 else:
-                    results.append({
-                        "path": change["path"],
-                        "status": "failed",
-                        "error": response.text
-                    })
-            
-            return {
-                "message": "Push completed",
-                "results": results,
-                "totalFiles": len(request.changes),
-                "successCount": len([r for r in results if r["status"] == "success"])
-            }
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to push changes: {str(e)}")
+                    # Another worker got there first, or the chat was cleared meanwhile
+                    summary_stats["stale"] += 1
+                    continue
+            if user_id not in summary_rerun:
+                return
+    except Exception as e:
+        summary_stats["failed"] += 1
+        chat_logger.warning("Chat summary failed", extra={"user_id": user_id, "error": str(e)})
+
+def schedule_summary(user_id: str):
+    """Summarize aged-out turns in the background; one task per user at a time"""
+    task = summary_tasks.get(user_id)
+    if task is not None and not task.done():
+        summary_rerun.add(user_id)
+        return
+    task = asyncio.create_task(run_summary(user_id))
+    summary_tasks[user_id] = task
+
+    def finished(done):
+        if summary_tasks.get(user_id) is done:
+            del summary_tasks[user_id]
+
+    task.add_done_callback(finished)
+
+def cancel_summaries():
+    # Pending messages stay in the store and are picked up after the next turn
+    for task in list(summary_tasks.values()):
+        task.cancel()
 
 # ==================== CHAT & AI ANALYSIS ====================
 
+async def record_chat_turn(user_id: str, request: AnalyzeRequest, response_text: str) -> List[Dict]:
+    """Append a user/assistant exchange to the user's chat memory and return the recent history"""
+    user_message = {
+        "role": "user",
+        "content": request.prompt,
+        "timestamp": datetime.now().isoformat(),
+        "fileContext": {
+            "path": request.currentFile.get("path") if request.currentFile else None,
+            "hasSelection": bool(request.selectedCode)
+        }
+    }
+    
+    assistant_message = {
+        "role": "assistant",
+        "content": response_text,
+        "timestamp": datetime.now().isoformat()
+    }
+    
+    history, pending = await asyncio.to_thread(
+        session_store.append_chat, user_id, [user_message, assistant_message], MAX_CHAT_MESSAGES
+    )
+    if pending:
+        schedule_summary(user_id)
+    return history
+
 @app.post("/api/chat")
 async def chat_with_ai(
     request: AnalyzeRequest,
@@ -685,150 +4176,228 @@ async def chat_with_ai(
         raise HTTPException(status_code=400, detail="Prompt is required")
     
     user_id = str(current_user["id"])
-    
-    if user_id not in chat_history:
-        chat_history[user_id] = []
+    history = session_store.get_chat(user_id)
     
     # Build context-aware prompt
-    system_prompt = build_system_prompt()
-    user_prompt = build_user_prompt(request, chat_history[user_id])
+    system_prompt = build_system_prompt(session_store.get_chat_summary(user_id))
+    user_prompt = build_user_prompt(request, history, chat_snippets(request, current_user), system_prompt)
     
+    cached = False
     try:
         # Call Hugging Face API with DeepSeek
         if HF_TOKEN:
-            print(f"[CHAT] User {user_id} asking: {request.prompt[:100]}")
-            response_text = await call_deepseek_api(system_prompt, user_prompt, chat_history[user_id])
-            print(f"[CHAT] AI responded: {response_text[:100]}...")
+            chat_logger.info("Chat request", extra={"user_id": user_id, "prompt_chars": len(request.prompt)})
+            cache_key = llm_cache_key(system_prompt, user_prompt, history, request)
+            response_text = lookup_cached_response(cache_key, request)
+            cached = response_text is not None
+            if not cached:
+                # Fail over to the fallback at once rather than queueing behind a dead router
+                if router_circuit.is_open():
+                    raise CircuitOpenError()
+                response_text = await llm_dispatcher.run(
+                    None if request.noCache else cache_key,
+                    user_id,
+                    lambda: call_deepseek_api(system_prompt, user_prompt, history)
+                )
+                llm_cache.put(cache_key, response_text)
+            chat_logger.info("Chat response", extra={"user_id": user_id, "response_chars": len(response_text), "cached": cached})
         else:
-            print("[CHAT] No HF_TOKEN, using mock response")
+            chat_logger.info("No HF_TOKEN, using mock response", extra={"sample": True})
             response_text = generate_mock_response(request)
         
-        # Store messages in history
-        user_message = {
-            "role": "user",
-            "content": request.prompt,
-            "timestamp": datetime.now().isoformat(),
-            "fileContext": {
-                "path": request.currentFile.get("path") if request.currentFile else None,
-                "hasSelection": bool(request.selectedCode)
-            }
-        }
-        chat_history[user_id].append(user_message)
-        
-        assistant_message = {
-            "role": "assistant",
-            "content": response_text,
-            "timestamp": datetime.now().isoformat()
-        }
-        chat_history[user_id].append(assistant_message)
-        
-        # Keep only last 20 messages
-        if len(chat_history[user_id]) > 20:
-            chat_history[user_id] = chat_history[user_id][-20:]
+        history = await record_chat_turn(user_id, request, response_text)
         
         return {
             "response": response_text,
-            "conversationHistory": chat_history[user_id]
+            "conversationHistory": history,
+            "cached": cached
         }
     
     except Exception as e:
-        print(f"[CHAT] AI Error: {str(e)}")
-        print(f"[CHAT] Falling back to mock response")
+        chat_logger.warning("AI error, falling back to mock response", extra={"user_id": user_id, "error": str(e)})
         response_text = generate_mock_response(request)
         return {
             "response": response_text,
-            "conversationHistory": chat_history.get(user_id, []),
+            "conversationHistory": history,
             "error": str(e),
             "fallback": True
         }
 
-async def call_deepseek_api(system_prompt: str, user_prompt: str, history: List[Dict]) -> str:
-    """Call AI model via Hugging Face Router API"""
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Format one Server-Sent Event"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+@app.post("/api/chat/stream")
+async def chat_with_ai_stream(
+    request: AnalyzeRequest,
+    http_request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """Chat with AI assistant, streaming the answer token by token as Server-Sent Events"""
+    if not request.prompt:
+        raise HTTPException(status_code=400, detail="Prompt is required")
     
-    # Build messages for chat completion
-    messages = [
-        {"role": "system", "content": system_prompt}
-    ]
+    user_id = str(current_user["id"])
+    history = session_store.get_chat(user_id)
+    system_prompt = build_system_prompt(session_store.get_chat_summary(user_id))
+    user_prompt = build_user_prompt(request, history, chat_snippets(request, current_user), system_prompt)
     
-    # Add conversation history
-    recent_history = history[-4:] if len(history) > 4 else history
-    for msg in recent_history:
-        messages.append({
-            "role": msg["role"],
-            "content": msg["content"][:500]  # Limit history length
-        })
+    async def event_stream():
+        parts = []
+        fallback = None
+        cached = False
+        try:
+            if HF_TOKEN:
+                cache_key = llm_cache_key(system_prompt, user_prompt, history, request)
+                cached_text = lookup_cached_response(cache_key, request)
+                if cached_text is not None:
+                    cached = True
+                    parts.append(cached_text)
+                    yield sse_event({"delta": cached_text})
+                else:
+                    async for delta in dispatch_stream(user_id, system_prompt, user_prompt, history):
+                        # Leaving the generator closes the upstream stream and cancels generation
+                        if await http_request.is_disconnected():
+                            return
+                        parts.append(delta)
+                        yield sse_event({"delta": delta})
+                    llm_cache.put(cache_key, "".join(parts).strip())
+            else:
+                parts.append(generate_mock_response(request))
+                yield sse_event({"delta": parts[-1]})
+        except Exception as e:
+            chat_logger.warning("AI stream error", extra={"user_id": user_id, "error": str(e), "partial": bool(parts)})
+            if parts:
+                yield sse_event({"error": str(e)}, event="error")
+                return
+            fallback = str(e)
+            parts.append(generate_mock_response(request))
+            yield sse_event({"delta": parts[-1]})
+        
+        response_text = "".join(parts).strip()
+        if fallback is None:
+            await record_chat_turn(user_id, request, response_text)
+        done = {"response": response_text, "cached": cached}
+        if fallback is not None:
+            done.update({"error": fallback, "fallback": True})
+        yield sse_event(done, event="done")
     
-    # Add current user prompt
-    messages.append({"role": "user", "content": user_prompt})
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def stream_deepseek_api(system_prompt: str, user_prompt: str, history: List[Dict]):
+    """Stream completion deltas from the Hugging Face Router API.
+
+    Failures are retried only until the first delta has been sent on.
+    """
+    messages = build_chat_messages(system_prompt, user_prompt, history)
+    client = get_ai_client()
+    deadline = time.monotonic() + AI_DEADLINE
+    attempt = 0
     
-    # Call Hugging Face Router API (new endpoint)
-    async with httpx.AsyncClient(timeout=90.0) as client:
+    while True:
+        router_circuit.before_call()
+        started = False
+        started_at = time.perf_counter()
         try:
-            print(f"[AI] Calling Hugging Face Router API...")
-            
-            response = await client.post(
-                "https://router.huggingface.co/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {HF_TOKEN}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "Qwen/Qwen2.5-Coder-32B-Instruct",
-                    "messages": messages,
-                    "max_tokens": 2000,
-                    "temperature": 0.7,
-                    "top_p": 0.95,
-                    "stream": False
-                }
-            )
-            
-            print(f"[AI] Response status: {response.status_code}")
-            
-            if response.status_code == 503:
-                # Model is loading, wait and retry
-                print("[AI] Model is loading, retrying in 10 seconds...")
-                await asyncio.sleep(10)
+            async with client.stream(
+                "POST",
+                HF_ROUTER_URL,
+                headers=ai_headers(),
+                json=build_completion_payload(messages, stream=True),
+                timeout=min(AI_TIMEOUT, deadline - time.monotonic())
+            ) as response:
+                llm_requests.inc("stream", response.status_code)
+                if response.status_code != 200:
+                    error_text = (await response.aread()).decode("utf-8", errors="replace")
+                    raise router_error(response, error_text)
                 
-                response = await client.post(
-                    "https://router.huggingface.co/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {HF_TOKEN}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": "Qwen/Qwen2.5-Coder-32B-Instruct",
-                        "messages": messages,
-                        "max_tokens": 2000,
-                        "temperature": 0.7,
-                        "top_p": 0.95,
-                        "stream": False
-                    }
-                )
-            
-            if response.status_code != 200:
-                error_text = response.text
-                print(f"[AI] API Error: {response.status_code} - {error_text}")
-                raise Exception(f"API returned status {response.status_code}: {error_text}")
-            
-            result = response.json()
-            print(f"[AI] Response received: {str(result)[:200]}...")
-            
-            # Extract response from OpenAI-compatible format
-            if "choices" in result and len(result["choices"]) > 0:
-                content = result["choices"][0]["message"]["content"]
-                return content.strip()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    record_llm_usage(chunk.get("usage"))
+                    choices = chunk.get("choices") or []
+                    if choices:
+                        delta = (choices[0].get("delta") or {}).get("content")
+                        if delta:
+                            if not started:
+                                llm_first_token_seconds.observe(value=time.perf_counter() - started_at)
+                            started = True
+                            yield delta
+        except BaseException as e:
+            router_circuit.record_error(e)
+            if started or not isinstance(e, Exception):
+                raise
+            delay = next_retry_delay(e, attempt, deadline)
+            if delay is None:
+                raise
+            ai_logger.info("Router stream failed, retrying", extra={"attempt": attempt + 1, "error": str(e)[:200], "delay": round(delay, 3)})
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        router_circuit.record_success()
+        llm_request_seconds.observe("stream", value=time.perf_counter() - started_at)
+        return
+
+async def call_deepseek_api(system_prompt: str, user_prompt: str, history: List[Dict]) -> str:
+    """Call AI model via Hugging Face Router API"""
+    
+    messages = build_chat_messages(system_prompt, user_prompt, history)
+    client = get_ai_client()
+    
+    async def post(timeout: float) -> httpx.Response:
+        started_at = time.perf_counter()
+        response = await client.post(
+            HF_ROUTER_URL,
+            headers=ai_headers(),
+            json=build_completion_payload(messages),
+            timeout=timeout
+        )
+        ai_logger.debug("Router response", extra={"status": response.status_code, "sample": True})
+        llm_request_seconds.observe("complete", value=time.perf_counter() - started_at)
+        llm_requests.inc("complete", response.status_code)
+        if response.status_code != 200:
+            ai_logger.warning("Router error", extra={"status": response.status_code, "body": response.text[:500]})
+            raise router_error(response, response.text)
+        return response
+    
+    # Call Hugging Face Router API (new endpoint)
+    try:
+        ai_logger.debug("Calling Hugging Face Router API", extra={"sample": True})
+        
+        # 503 while the model loads is retried with backoff like any other transient failure
+        response = await call_router_with_retries(post)
+        
+        result = response.json()
+        ai_logger.debug("Router response received", extra={"usage": result.get("usage"), "sample": True})
+        record_llm_usage(result.get("usage"))
+        
+        # Extract response from OpenAI-compatible format
+        if "choices" in result and len(result["choices"]) > 0:
+            content = result["choices"][0]["message"]["content"]
+            return content.strip()
+        
+        raise Exception(f"Unexpected API response format: {result}")
             
-            raise Exception(f"Unexpected API response format: {result}")
-                
-        except httpx.TimeoutException:
-            print("[AI] Request timed out")
-            raise Exception("API request timed out")
-        except Exception as e:
-            print(f"[AI] Error: {str(e)}")
-            raise
+    except httpx.TimeoutException:
+        ai_logger.warning("Router request timed out")
+        raise Exception("API request timed out")
+    except Exception as e:
+        ai_logger.warning("Router call failed", extra={"error": str(e)})
+        raise
 
-def build_system_prompt() -> str:
-    """Build system prompt for the AI"""
+def build_system_prompt(summary: str = "") -> str:
+    """Build system prompt for the AI, with the summary of turns no longer in the history"""
+    if summary:
+        return f"{build_system_prompt()}\n\nSummary of the earlier conversation:\n{summary}"
     return """You are CatAI, an expert code assistant. You MUST provide complete, working code solutions.
 
 CRITICAL RULES:
@@ -852,40 +4421,96 @@ httpx==0.25.1
 
 I added gunicorn version 21.2.0 to the requirements."""
 
-def build_user_prompt(request: AnalyzeRequest, history: List[Dict]) -> str:
-    """Build user prompt with context"""
+def chat_snippets(request: AnalyzeRequest, current_user: dict) -> List[str]:
+    """Related code from the repository's search index, if the user has opened it"""
+    if not request.owner or not request.repo:
+        return []
+    repo_key = f"{request.owner}/{request.repo}"
+    if not has_repo_access(current_user["id"], repo_key):
+        return []
+    current_path = request.currentFile.get('path') if request.currentFile else None
+    return related_snippets(repo_key, f"{request.selectedCode or ''} {request.prompt}", current_path)
+
+def build_user_prompt(
+    request: AnalyzeRequest,
+    history: List[Dict],
+    snippets: Optional[List[str]] = None,
+    system_prompt: Optional[str] = None
+) -> str:
+    """Build user prompt with context packed into the token budget.
+
+    Priority order is the request itself, the selection, the code around the
+    selection, the rest of the file and then related snippets from other
+    files; history gets what is left.
+    """
+    
+    request_part = f"\n**User Request:** {request.prompt}"
+    budget = (
+        PROMPT_TOKEN_BUDGET
+        - PROMPT_HISTORY_RESERVE_TOKENS
+        - count_tokens(system_prompt or build_system_prompt())
+        - count_tokens(request_part)
+    )
+    
+    # Add selected code if exists
+    selection_part = None
+    if request.selectedCode:
+        selection = truncate_to_tokens(request.selectedCode, budget - 16)
+        selection_part = f"\n**Selected Code:**\n```\n{selection}\n```"
+        budget -= count_tokens(selection_part)
     
     prompt_parts = []
     
     # Add current file context
     if request.currentFile and request.currentFile.get('path'):
-        prompt_parts.append(f"**Current File:** `{request.currentFile.get('path')}`")
+        header = f"**Current File:** `{request.currentFile.get('path')}`"
+        prompt_parts.append(header)
+        budget -= count_tokens(header)
         
-        if request.currentFile.get('content'):
-            content_preview = request.currentFile.get('content')[:1500]
-            prompt_parts.append(f"\n**File Content:**\n```\n{content_preview}\n```")
+        content = request.currentFile.get('content')
+        if content and budget > 16:
+            excerpt, first_line, last_line, total_lines = pack_file_excerpt(
+                content, request.selectedCode or "", budget - 16, request.currentFile.get('sha')
+            )
+            if excerpt:
+                label = "**File Content:**"
+                if first_line > 1 or last_line < total_lines:
+                    label = f"**File Content (lines {first_line}-{last_line} of {total_lines}):**"
+                prompt_parts.append(f"\n{label}\n```\n{excerpt}\n```")
+                budget -= count_tokens(prompt_parts[-1])
     
-    # Add selected code if exists
-    if request.selectedCode:
-        prompt_parts.append(f"\n**Selected Code:**\n```\n{request.selectedCode}\n```")
+    # Related code elsewhere in the repository, while budget remains
+    if snippets:
+        related = ["\n**Related Code:**"]
+        budget -= count_tokens(related[0])
+        for snippet in snippets:
+            cost = count_tokens(snippet)
+            if cost > budget:
+                break
+            related.append(snippet)
+            budget -= cost
+        if len(related) > 1:
+            prompt_parts.append("\n".join(related))
+    
+    if selection_part:
+        prompt_parts.append(selection_part)
     
     # Add user's question
-    prompt_parts.append(f"\n**User Request:** {request.prompt}")
+    prompt_parts.append(request_part)
     
     return "\n".join(prompt_parts)
 
 @app.get("/api/chat/history")
 async def get_chat_history(current_user: dict = Depends(get_current_user)):
-    """Get chat history for current user"""
+    """Get chat history and the summary of older turns for current user"""
     user_id = str(current_user["id"])
-    return {"history": chat_history.get(user_id, [])}
+    return {"history": session_store.get_chat(user_id), "summary": session_store.get_chat_summary(user_id)}
 
 @app.delete("/api/chat/history")
 async def clear_chat_history(current_user: dict = Depends(get_current_user)):
     """Clear chat history for current user"""
     user_id = str(current_user["id"])
-    if user_id in chat_history:
-        chat_history[user_id] = []
+    await asyncio.to_thread(session_store.clear_chat, user_id)
     return {"message": "Chat history cleared"}
 
 def generate_mock_response(request: AnalyzeRequest) -> str:
@@ -914,28 +4539,6 @@ Would you like me to help implement any of these improvements?"""
     
     return response
 
-def build_tree_structure(items: List[Dict]) -> List[Dict]:
-    tree = []
-    path_dict = {}
-    items_sorted = sorted(items, key=lambda x: (x['path'].count('/'), x['path']))
-    for item in items_sorted:
-        path = item['path']
-        parts = path.split('/')
-        node = {"name": parts[-1], "path": path, "type": "folder" if item['type'] == 'tree' else "file"}
-        if item['type'] == 'tree':
-            node["children"] = []
-            node["expanded"] = False
-        path_dict[path] = node
-        if len(parts) == 1:
-            tree.append(node)
-        else:
-            parent_path = '/'.join(parts[:-1])
-            if parent_path in path_dict:
-                if "children" not in path_dict[parent_path]:
-                    path_dict[parent_path]["children"] = []
-                path_dict[parent_path]["children"].append(node)
-    return tree
-
 # ==================== HEALTH CHECK ====================
 
 @app.get("/health")
@@ -943,9 +4546,20 @@ async def health_check():
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "ai_available": HF_TOKEN is not None
+        "ai_available": HF_TOKEN is not None,
+        "llm_cache": llm_cache.stats(),
+        "llm_dispatcher": llm_dispatcher.stats(),
+        "router_circuit": router_circuit.stats(),
+        "prefetch": dict(prefetch_stats, running=len(prefetch_tasks)),
+        "chat_summary": dict(summary_stats, running=len(summary_tasks)),
+        "webhooks": dict(repo_events.stats(), configured=bool(GITHUB_WEBHOOK_SECRET))
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of this worker's metrics"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))